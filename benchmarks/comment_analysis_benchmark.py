@@ -0,0 +1,67 @@
+"""
+Compares the single-pass comment analyzer against the original per-consumer regex searches, in
+comments analyzed per second, on the comments of a synthetic corpus (see benchmarks/corpus.py).
+
+Run from the repository root, with lib/ on the PYTHONPATH:
+
+    CI=true python -m benchmarks.comment_analysis_benchmark
+"""
+import re
+import timeit
+
+from benchmarks.corpus import generate_corpus
+from sparkprs import utils
+from sparkprs.utils import JENKINS_COMMAND_REGEX, ASKED_TO_CLOSE_REGEX
+
+
+def legacy_analysis(body):
+    """
+    The original analysis of a comment, which ran separate uncompiled regex searches and
+    substring checks for each consumer: the commenters list, the Jenkins outcome and the
+    obsolete bot comment cleanup.
+    """
+    lowercase_body = body.lower()
+    start_match = re.search(r"Test build #(\d+) has started", body)
+    end_match = re.search(r"Test build #(\d+) (has finished|timed out)", body)
+    return {
+        'only_jenkins_commands': re.match("^(%s\s*)+$" % JENKINS_COMMAND_REGEX,
+                                          body.strip().replace(r"\n", ' '),
+                                          re.I | re.X) is not None,
+        'lgtm': re.search("lgtm", body, re.I) is not None,
+        'asked_to_close': re.search(ASKED_TO_CLOSE_REGEX, body, re.I | re.X) is not None,
+        'jenkins_command':
+            re.search(JENKINS_COMMAND_REGEX, lowercase_body, re.I | re.X) is not None,
+        'verify': "can one of the admins verify this patch?" in lowercase_body,
+        'passed': "pass" in lowercase_body,
+        'failed': "fail" in lowercase_body,
+        'started': "started" in lowercase_body,
+        'timed_out': "timed out" in lowercase_body,
+        'started_build': start_match and start_match.group(1),
+        'ended_build': end_match and end_match.group(1),
+    }
+
+
+def main():
+    (prs, _) = generate_corpus(1000)
+    comments = [c for pr in prs for c in pr['comments_json'] + pr['pr_comments_json']]
+    bodies = [c['body'] for c in comments]
+    for body in bodies:
+        assert legacy_analysis(body) == utils.analyze_comment(body), body
+
+    def analyze_cached():
+        for comment in comments:
+            utils.analyze_github_comment(comment)
+
+    utils.MAX_CACHED_ANALYSES = len(comments)
+    analyze_cached()  # Warm the cache
+    print "%-30s %15s" % ("analysis", "comments/sec")
+    for (name, func) in [
+            ("legacy", lambda: [legacy_analysis(body) for body in bodies]),
+            ("single-pass", lambda: [utils.analyze_comment(body) for body in bodies]),
+            ("single-pass (cached)", analyze_cached)]:
+        seconds = min(timeit.repeat(func, number=1, repeat=3))
+        print "%-30s %15.0f" % (name, len(comments) / seconds)
+
+
+if __name__ == "__main__":
+    main()
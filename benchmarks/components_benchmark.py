@@ -0,0 +1,54 @@
+"""
+Compares Issue.components' ComponentClassifier against the original per-file regex loop.
+
+Run from the repository root, with the App Engine SDK and lib/ on the PYTHONPATH:
+
+    python -m benchmarks.components_benchmark
+"""
+import random
+import re
+import timeit
+
+from benchmarks.corpus import DIRECTORIES
+from sparkprs.models import Issue
+
+
+def legacy_components(title, modified_files):
+    """
+    The original implementation of Issue.components, which searches every file name with every
+    uncompiled filename regex.
+    """
+    components = []
+    for (component_name, pr_title_regex, filename_regex) in Issue._components:
+        if re.search(pr_title_regex, title, re.IGNORECASE) or \
+                any(re.search(filename_regex, f, re.I) for f in modified_files):
+            components.append(component_name)
+    return components or ["Core"]
+
+
+def classifier_components(title, modified_files):
+    return Issue._component_classifier.classify(title, modified_files) or ["Core"]
+
+
+def random_files(rng, num_files):
+    return ["%s/File%i.scala" % (rng.choice(DIRECTORIES), i) for i in xrange(num_files)]
+
+
+def main():
+    rng = random.Random(42)
+    title = "[SPARK-12345] Refactor the physical planner"
+    print "%10s %15s %15s %10s" % ("files", "legacy (ms)", "classifier (ms)", "speedup")
+    for num_files in (10, 100, 1000, 5000):
+        files = random_files(rng, num_files)
+        assert legacy_components(title, files) == classifier_components(title, files)
+        repeat = max(1, 2000 / num_files)
+        legacy = min(timeit.repeat(lambda: legacy_components(title, files),
+                                   number=repeat, repeat=3)) / repeat
+        classifier = min(timeit.repeat(lambda: classifier_components(title, files),
+                                       number=repeat, repeat=3)) / repeat
+        print "%10i %15.3f %15.3f %9.1fx" % \
+            (num_files, legacy * 1000, classifier * 1000, legacy / classifier)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Generates a seeded, synthetic corpus of pull requests and JIRA issues for the benchmarks.
+
+The numbers of comments, review comments and modified files per pull request follow long-tailed
+distributions like the Spark repository's: most pull requests are small, but a few have hundreds
+of comments or thousands of files.  The JSON has the same shapes as the JSON that the sync tasks
+store, so it can populate `Issue` and `JIRAIssue` entities directly.
+"""
+import datetime
+import random
+
+
+# Directories that large Spark pull requests commonly touch:
+DIRECTORIES = [
+    "core/src/main/scala/org/apache/spark/scheduler",
+    "core/src/main/scala/org/apache/spark/ui/jobs",
+    "sql/catalyst/src/main/scala/org/apache/spark/sql/catalyst/expressions",
+    "sql/core/src/main/scala/org/apache/spark/sql/execution/datasources",
+    "sql/hive/src/test/scala/org/apache/spark/sql/hive/execution",
+    "mllib/src/main/scala/org/apache/spark/ml/feature",
+    "python/pyspark/sql",
+    "R/pkg/R",
+    "docs",
+    "resource-managers/kubernetes/core/src/main/scala",
+    "streaming/src/main/scala/org/apache/spark/streaming/dstream",
+]
+
+TITLE_TAGS = ["CORE", "SQL", "PYTHON", "ML", "MLLIB", "STREAMING", "YARN", "K8S", "BUILD", "DOCS",
+              "WEBUI", "SPARKR", "MINOR", "WIP"]
+
+TITLE_WORDS = ["Fix", "Add", "Support", "Refactor", "Remove", "Improve", "planner", "shuffle",
+               "metrics", "executor", "partition", "codegen", "serializer", "schema", "config",
+               "timeout", "memory", "leak", "null", "handling", "in", "for", "the", "when"]
+
+REVIEW_COMMENTS = [
+    "Can you add a test for this?",
+    "Nit: indentation.",
+    "Why is this change needed?",
+    "LGTM",
+    "LGTM, pending tests.",
+    "Looks good to me. Merging to master.",
+    "Would you mind closing this PR? It has gone stale.",
+    "Thanks, I'll take another look tomorrow.",
+    "This breaks binary compatibility; please add a MiMa exclude.",
+]
+
+JENKINS_COMMANDS = ["Jenkins, test this please", "retest this please", "ok to test",
+                    "Jenkins, add to whitelist"]
+
+PRIORITIES = ["Blocker", "Critical", "Major", "Minor", "Trivial"]
+ISSUE_TYPES = ["Bug", "Improvement", "New Feature", "Sub-task", "Documentation"]
+VERSIONS = ["2.4.0", "2.4.1", "3.0.0", "3.0.1", "3.1.0"]
+
+START_DATE = datetime.datetime(2018, 1, 1)
+
+
+def _long_tailed(rng, median, sigma, maximum):
+    return min(maximum, int(rng.lognormvariate(0, sigma) * median))
+
+
+def _timestamp(date):
+    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _user_json(login):
+    return {'login': login, 'avatar_url': "https://avatars.example.com/%s" % login}
+
+
+def _title(rng, jira_numbers):
+    title = ''.join("[SPARK-%i]" % n for n in jira_numbers)
+    title += ''.join("[%s]" % tag for tag in rng.sample(TITLE_TAGS, rng.choice([0, 0, 1, 1, 2])))
+    words = ' '.join(rng.choice(TITLE_WORDS) for _ in xrange(rng.randint(3, 12)))
+    return ("%s %s" % (title, words)).strip()
+
+
+def _comments(rng, number, created_at, users):
+    """
+    Returns a PR's comments: a mix of review discussion, Jenkins commands and the bots' build
+    status comments, in chronological order.
+    """
+    comments = []
+    date = created_at
+    for build in xrange(_long_tailed(rng, 3, 1.0, 100)):
+        date += datetime.timedelta(minutes=rng.randint(1, 600))
+        posts = []
+        if rng.random() < 0.3:
+            posts.append((rng.choice(users), rng.choice(JENKINS_COMMANDS)))
+        build_id = rng.randint(10000, 99999)
+        posts.append(("SparkQA", "Test build #%i has started for PR %i at commit abc123." %
+                      (build_id, number)))
+        outcome = rng.choice(["passes all tests", "fails Spark unit tests", "timed out"])
+        posts.append(("SparkQA", "Test build #%i has finished for PR %i at commit abc123.\n"
+                      " * This patch **%s**." % (build_id, number, outcome)))
+        if outcome != "passes all tests":
+            posts.append(("AmplabJenkins", "Test FAILed.\nRefer to this link for build results."))
+        for _ in xrange(_long_tailed(rng, 2, 1.0, 50)):
+            posts.append((rng.choice(users), rng.choice(REVIEW_COMMENTS)))
+        for (login, body) in posts:
+            date += datetime.timedelta(seconds=rng.randint(1, 3600))
+            comments.append((login, body, date))
+    return [{
+        'id': number * 10000 + i,
+        'url': "https://api.github.com/repos/apache/spark/issues/comments/%i" %
+               (number * 10000 + i),
+        'html_url': "https://github.com/apache/spark/pull/%i#issuecomment-%i" % (number, i),
+        'body': body,
+        'created_at': _timestamp(date),
+        'updated_at': _timestamp(date),
+        'user': _user_json(login),
+    } for (i, (login, body, date)) in enumerate(comments)]
+
+
+def _review_comments(rng, number, created_at, users):
+    review_comments = []
+    date = created_at
+    for i in xrange(_long_tailed(rng, 3, 1.2, 300)):
+        date += datetime.timedelta(minutes=rng.randint(1, 600))
+        comment_id = number * 10000 + 5000 + i
+        review_comments.append({
+            'id': comment_id,
+            'url': "https://api.github.com/repos/apache/spark/pulls/comments/%i" % comment_id,
+            'html_url': "https://github.com/apache/spark/pull/%i#discussion_r%i" %
+                        (number, comment_id),
+            'body': rng.choice(REVIEW_COMMENTS),
+            'created_at': _timestamp(date),
+            'updated_at': _timestamp(date),
+            'user': _user_json(rng.choice(users)),
+            'diff_hunk': '\n'.join("+  val x%i = %i" % (j, j) for j in xrange(rng.randint(1, 30))),
+        })
+    return review_comments
+
+
+def _files(rng):
+    directories = rng.sample(DIRECTORIES, rng.randint(1, 3))
+    return [{
+        'filename': "%s/File%i.scala" % (rng.choice(directories), i),
+        'additions': rng.randint(0, 200),
+        'deletions': rng.randint(0, 100),
+    } for i in xrange(max(1, _long_tailed(rng, 4, 1.4, 3000)))]
+
+
+def _jira_json(rng, jira_number):
+    priority = rng.choice(PRIORITIES) if rng.random() < 0.95 else None
+    return {
+        'key': "SPARK-%i" % jira_number,
+        'fields': {
+            'status': {
+                'statusCategory': {'name': "Complete" if rng.random() < 0.1 else "In Progress"},
+                'iconUrl': "https://issues.example.com/status.png",
+            },
+            'priority': priority and {'name': priority,
+                                      'iconUrl': "https://issues.example.com/%s.png" % priority},
+            'issuetype': {'name': rng.choice(ISSUE_TYPES),
+                          'iconUrl': "https://issues.example.com/issuetype.png"},
+            'customfield_12311620':
+                {'displayName': "Shepherd %i" % rng.randint(1, 20)} if rng.random() < 0.1 else None,
+            'customfield_12310320':
+                [{'name': v} for v in rng.sample(VERSIONS, rng.choice([0, 1, 1, 2]))],
+        },
+    }
+
+
+def generate_corpus(num_prs, seed=42):
+    """
+    Generates `num_prs` pull requests and the JIRA issues that they reference.
+
+    :return: a (prs, jiras) pair.  Each PR is a dict with `pr_json`, `comments_json`,
+             `pr_comments_json` and `files_json` keys; `jiras` maps JIRA numbers to their JSON.
+    """
+    rng = random.Random(seed)
+    users = ["contributor%i" % i for i in xrange(max(10, num_prs / 5))]
+    prs = []
+    jiras = {}
+    for number in xrange(1, num_prs + 1):
+        created_at = START_DATE + datetime.timedelta(minutes=rng.randint(0, 2 * 365 * 24 * 60))
+        num_jiras = rng.choice([0, 1, 1, 1, 2])
+        jira_numbers = [rng.randint(20000, 20000 + num_prs) for _ in xrange(num_jiras)]
+        for jira_number in jira_numbers:
+            if jira_number not in jiras:
+                jiras[jira_number] = _jira_json(rng, jira_number)
+        comments = _comments(rng, number, created_at, users)
+        review_comments = _review_comments(rng, number, created_at, users)
+        files = _files(rng)
+        updated_at = max([_timestamp(created_at)] +
+                         [c['updated_at'] for c in comments + review_comments])
+        author = rng.choice(users)
+        pr_json = {
+            'number': number,
+            'title': _title(rng, jira_numbers),
+            'state': "open" if rng.random() < 0.1 else "closed",
+            'merged': False,
+            'mergeable': rng.choice([True, True, False, None]),
+            'additions': sum(f['additions'] for f in files),
+            'deletions': sum(f['deletions'] for f in files),
+            'created_at': _timestamp(created_at),
+            'updated_at': updated_at,
+            'html_url': "https://github.com/apache/spark/pull/%i" % number,
+            'user': _user_json(author),
+            'head': {'sha': "%040x" % rng.getrandbits(160)},
+            'base': {'ref': "master"},
+        }
+        prs.append({
+            'pr_json': pr_json,
+            'comments_json': comments,
+            'pr_comments_json': review_comments,
+            'files_json': files,
+        })
+    return (prs, jiras)
@@ -0,0 +1,208 @@
+"""
+Times the hot paths of the sync tasks and the PR list endpoints against a synthetic corpus (see
+benchmarks/corpus.py), using the App Engine testbed's local datastore and memcache stubs.
+
+Run from the repository root, with the App Engine SDK and lib/ on the PYTHONPATH:
+
+    CI=true python -m benchmarks.hot_paths_benchmark [--prs 2000] [--seed 42] [--save-baseline]
+
+Results are compared against the saved baseline, if there is one for the same corpus, and
+slowdowns of more than REGRESSION_THRESHOLD are flagged.  Pass --save-baseline to record the
+results as the new baseline.  Timings are machine-specific, so only compare against baselines
+that were recorded on the same machine.
+
+Memory is reported as the growth of the process's peak resident set size while a benchmark runs,
+so it only shows benchmarks that need more memory than everything that ran before them.
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import resource
+import time
+
+import google.appengine.ext.ndb as ndb
+from google.appengine.ext import testbed
+
+from benchmarks.corpus import generate_corpus
+from sparkprs.controllers.prs import search_prs, stream_prs_json
+from sparkprs.models import Issue, IssueSummary, JIRAIssue
+from sparkprs.utils import parse_pr_title, is_jenkins_command, compute_last_jenkins_outcome
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baselines', 'hot_paths.json')
+# Benchmarks that are slower than their baseline by more than this fraction are flagged:
+REGRESSION_THRESHOLD = 0.2
+
+
+def setup_testbed():
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    # Measure datastore access rather than ndb's in-context cache and memcache:
+    ndb.get_context().set_cache_policy(False)
+    ndb.get_context().set_memcache_policy(False)
+    return bed
+
+
+def load_corpus(prs, jiras):
+    """
+    Stores the corpus as JIRAIssue, Issue, IssueData and IssueSummary entities, returning the
+    issues.
+    """
+    ndb.put_multi([JIRAIssue(id="SPARK-%i" % number, issue_id="SPARK-%i" % number,
+                             issue_json=issue_json) for (number, issue_json) in jiras.items()])
+    issues = []
+    for pr in prs:
+        pr_json = pr['pr_json']
+        issue = Issue(
+            id=str(pr_json['number']), number=pr_json['number'], state=pr_json['state'],
+            user=pr_json['user']['login'], title=pr_json['title'], pr_json=pr_json,
+            updated_at=datetime.datetime.strptime(pr_json['updated_at'], "%Y-%m-%dT%H:%M:%SZ"),
+            files_etag='"files-%i"' % pr_json['number'])
+        for name in Issue.DATA_NAMES:
+            setattr(issue, name, pr[name])
+        issues.append(issue)
+    ndb.put_multi(issues + [child for issue in issues for child in issue.modified_data()])
+    ndb.put_multi([IssueSummary.from_issue(issue) for issue in issues])
+    return issues
+
+
+def get_max_rss_kb():
+    # ru_maxrss is in kilobytes on Linux:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_benchmark(func, num_items, setup=None, repeat=3):
+    """
+    Runs `func` `repeat` times, calling `setup` (untimed) before each run, and returns the fastest
+    run's timings along with the peak memory growth.
+    """
+    timings = []
+    gc.collect()
+    max_rss_before = get_max_rss_kb()
+    for _ in xrange(repeat):
+        if setup:
+            setup()
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return {
+        'items': num_items,
+        'total_ms': min(timings) * 1000,
+        'per_item_us': min(timings) * 1e6 / max(1, num_items),
+        'max_rss_growth_kb': get_max_rss_kb() - max_rss_before,
+    }
+
+
+def run_benchmarks(issues):
+    titles = [issue.pr_json['title'] for issue in issues]
+    bodies = [c['body'] for issue in issues for c in issue.comments_json]
+    num_comments = sum(len(i.comments_json) + len(i.pr_comments_json) for i in issues)
+    num_files = sum(len(issue.files_json) for issue in issues)
+    open_query = IssueSummary.query(IssueSummary.state == "open").order(-IssueSummary.updated_at)
+    num_open = open_query.count()
+
+    def clear_components():
+        for issue in issues:
+            issue.components_cache_key = None
+
+    def clear_commenters():
+        for issue in issues:
+            (issue.cached_commenters, issue.commenters_state) = (None, None)
+
+    def compute_all_commenters():
+        for issue in issues:
+            issue.cached_commenters = issue._compute_commenters()
+
+    # (name, function, number of items processed, setup function)
+    benchmarks = [
+        ("parse_pr_title", lambda: [parse_pr_title(t) for t in titles], len(titles), None),
+        ("is_jenkins_command", lambda: [is_jenkins_command(b) for b in bodies], len(bodies),
+         None),
+        ("compute_last_jenkins_outcome",
+         lambda: [compute_last_jenkins_outcome(i.comments_json) for i in issues], len(bodies),
+         None),
+        ("Issue.components", lambda: [i.components for i in issues], num_files,
+         clear_components),
+        ("Issue._compute_commenters (full)", compute_all_commenters, num_comments,
+         clear_commenters),
+        # Every issue's commenters state is now up-to-date, so this only checks the digests:
+        ("Issue._compute_commenters (unchanged)", compute_all_commenters, num_comments, None),
+        ("search_prs (open PRs)", lambda: search_prs(open_query.fetch()), num_open, None),
+        ("stream_prs_json (open PRs)", lambda: ''.join(stream_prs_json(open_query)), num_open,
+         None),
+    ]
+    results = {}
+    for (name, func, num_items, setup) in benchmarks:
+        results[name] = run_benchmark(func, num_items, setup)
+        print_result(name, results[name])
+    return results
+
+
+def print_result(name, result):
+    print "%-40s %10i %12.1f %12.2f %12i" % \
+        (name, result['items'], result['total_ms'], result['per_item_us'],
+         result['max_rss_growth_kb'])
+
+
+def compare_to_baseline(results, baseline):
+    print
+    print "%-40s %12s %12s %10s" % ("benchmark", "baseline ms", "current ms", "change")
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['total_ms']
+        change = (result['total_ms'] - before) / before if before else 0.0
+        flag = ""
+        if change > REGRESSION_THRESHOLD:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print "%-40s %12.1f %12.1f %+9.0f%%%s" % \
+            (name, before, result['total_ms'], change * 100, flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--prs', type=int, default=2000, help="number of PRs to generate")
+    parser.add_argument('--seed', type=int, default=42, help="seed for the corpus generator")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="baseline file")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="save the results as the new baseline")
+    args = parser.parse_args()
+
+    bed = setup_testbed()
+    try:
+        (prs, jiras) = generate_corpus(args.prs, args.seed)
+        issues = load_corpus(prs, jiras)
+        del prs
+        print "%-40s %10s %12s %12s %12s" % \
+            ("benchmark", "items", "total ms", "us/item", "max RSS +KB")
+        results = run_benchmarks(issues)
+    finally:
+        bed.deactivate()
+
+    corpus = {'prs': args.prs, 'seed': args.seed}
+    if args.save_baseline:
+        if not os.path.isdir(os.path.dirname(args.baseline)):
+            os.makedirs(os.path.dirname(args.baseline))
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump({'corpus': corpus, 'results': results}, baseline_file, indent=2,
+                      sort_keys=True)
+        print "Saved baseline to %s" % args.baseline
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['corpus'] != corpus:
+            print "Not comparing to the baseline, which was recorded for a different corpus: %s" \
+                % baseline['corpus']
+        elif compare_to_baseline(results, baseline):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
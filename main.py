@@ -8,6 +8,7 @@ from sparkprs.controllers.admin import admin
 from sparkprs.controllers.login import login
 from sparkprs.controllers.jenkins import jenkins
 from sparkprs.controllers.prs import prs
+from sparkprs.controllers.webhooks import webhooks
 
 # See the 'Requests' tab of
 # https://cloud.google.com/appengine/docs/standard/python/issue-requests#issuing_an_http_request
@@ -18,6 +19,7 @@ app.register_blueprint(jenkins)
 app.register_blueprint(prs)
 app.register_blueprint(tasks, url_prefix='/tasks')
 app.register_blueprint(admin, url_prefix='/admin')
+app.register_blueprint(webhooks, url_prefix='/webhooks')
 
 
 @app.route('/')
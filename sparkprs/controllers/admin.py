@@ -2,18 +2,20 @@ from flask import render_template, g, request, abort
 from flask import Blueprint
 
 from sparkprs.models import User
+from sparkprs.controllers.login import load_user
 
 
 admin = Blueprint('admin', __name__)
+admin.before_request(load_user)
 
 
 @admin.route("/add-role", methods=['POST'])
 def add_role():
     if not g.user or "admin" not in g.user.roles:
         return abort(403)
-    user = User.query(User.github_login == request.form["username"]).get()
+    user = User.get_by_login(request.form["username"])
     if user is None:
-        user = User(github_login=request.form["username"])
+        user = User(id=request.form["username"], github_login=request.form["username"])
     role = request.form["role"]
     if role not in user.roles:
         user.roles.append(role)
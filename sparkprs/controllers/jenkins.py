@@ -7,9 +7,11 @@ from google.appengine.api import urlfetch
 
 from sparkprs import app
 from sparkprs.models import Issue
+from sparkprs.controllers.login import load_user
 
 
 jenkins = Blueprint('jenkins', __name__)
+jenkins.before_request(load_user)
 
 
 @jenkins.route("/trigger-jenkins/<int:number>", methods=['GET', 'POST'])
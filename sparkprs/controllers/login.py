@@ -15,11 +15,18 @@ from sparkprs.github_api import github_request, BASE_AUTH_URL
 login = Blueprint('login', __name__)
 
 
-@app.before_request
-def before_request():
+def load_user():
+    """
+    Sets g.user to the signed-in user.  This is only registered to run before the requests of the
+    blueprints whose endpoints use g.user, so that the PR lists, tasks and webhooks don't pay for
+    the lookup.
+    """
     g.user = None
     if 'github_login' in session:
-        g.user = User.query(User.github_login == session['github_login']).get()
+        g.user = User.get_by_login(session['github_login'])
+
+
+login.before_request(load_user)
 
 
 @login.route('/github-callback')
@@ -47,9 +54,9 @@ def github_authorized_callback():
         return redirect(next_url)
     access_token = access_token[0].decode('ascii')
     user_json = json.loads(github_request("user", oauth_token=access_token).content)
-    user = User.query(User.github_login == user_json['login']).get()
+    user = User.get_by_login(user_json['login'])
     if user is None:
-        user = User(github_login=user_json['login'])
+        user = User(id=user_json['login'], github_login=user_json['login'])
     user.github_user_json = user_json
     user.github_access_token = access_token
     user.put()
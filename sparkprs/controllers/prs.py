@@ -1,72 +1,415 @@
 import google.appengine.ext.ndb as ndb
+from google.appengine.api import memcache, taskqueue
+from google.appengine.api.datastore_errors import BadRequestError, BadValueError
+from google.appengine.datastore.datastore_query import Cursor
+from collections import OrderedDict
+import hashlib
+import itertools
 import json
 import logging
 import datetime
+import threading
+import time
+import zlib
 
 from flask import Blueprint
-from flask import Response
+from flask import Response, request, abort, url_for
+from more_itertools import chunked
 from natsort import natsorted
+from werkzeug.datastructures import ImmutableMultiDict
 
 from sparkprs import cache, app
-from sparkprs.models import Issue, JIRAIssue
+from sparkprs.models import IssueSummary, JIRAIssue, RenderedPRList
 
 
 prs = Blueprint('prs', __name__)
 
 
+# Format of the version tokens that clients pass back via `since` to request incremental updates:
+VERSION_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+# Datastore indexes are eventually consistent, so incremental updates re-scan a short window
+# before the client's version; rows that are sent twice are harmless because clients upsert them.
+DELTA_OVERLAP = datetime.timedelta(minutes=1)
+
+# Query parameters that filter the PR list, and the indexed `IssueSummary` properties they match.
+# Every property here needs a composite index with each of the SORT_ORDERS in index.yaml, so that
+# the datastore can merge-join any combination of filters:
+FILTER_PARAMS = [
+    ('component', IssueSummary.components),
+    ('author', IssueSummary.user),
+    ('commenter', IssueSummary.commenters),
+    ('jenkins_outcome', IssueSummary.last_jenkins_outcome),
+    ('jira_priority', IssueSummary.jira_priority),
+    ('jira_target_version', IssueSummary.jira_target_versions),
+]
+SORT_ORDERS = {
+    'updated_at': IssueSummary.updated_at,
+    '-updated_at': -IssueSummary.updated_at,
+    'number': IssueSummary.number,
+    '-number': -IssueSummary.number,
+}
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Number of summaries to load, join with their JIRAs and serialize at a time when streaming a list:
+STREAM_BATCH_SIZE = 100
+
+# Pre-rendered lists that are older than this are re-rendered in the background, while their
+# current rendering continues to be served:
+RENDERED_LIST_MAX_AGE = datetime.timedelta(seconds=60)
+RENDERED_LIST_MEMCACHE_PREFIX = 'rendered-pr-list-'
+# Rendered lists are also cached in each instance's memory, in front of memcache:
+IN_PROCESS_CACHE_SIZE = 4
+IN_PROCESS_CACHE_TTL = 5  # seconds
+_rendered_lists = OrderedDict()  # name -> (time fetched, rendered list), least recent first
+_rendered_lists_lock = threading.Lock()
+# The last revalidation period in which this instance enqueued a render task for each list:
+_render_periods = {}
+# Any of these query parameters selects the filtered, paginated form of the PR list:
+SEARCH_PARAMS = set([param for (param, _) in FILTER_PARAMS] +
+                    ['stale', 'sort', 'page_size', 'cursor'])
+
+
 @prs.route('/search-open-prs')
-@cache.cached(timeout=60)
 def search_open_prs():
-    prs = Issue.query(Issue.state == "open").order(-Issue.updated_at).fetch()
-    return search_prs(prs)
+    """
+    Returns a JSON list of all open PRs, along with the version token of that list in the
+    X-PR-Version header.
+
+    If a `since=<version>` parameter is given, returns a JSON object describing only what has
+    changed since that version: `prs` lists the open PRs that were added or updated and `removed`
+    lists the numbers of PRs that are no longer open.  The object's `version` should be passed
+    as `since` in the next request.
+
+    The list can also be filtered, sorted and paginated on the server; see `search_filtered_prs`.
+    """
+    since = request.args.get('since')
+    if since is not None:
+        return search_open_prs_delta(since)
+    if SEARCH_PARAMS.intersection(request.args):
+        return search_filtered_prs()
+    return search_all_open_prs()
 
 
 @prs.route('/search-stale-prs')
-@cache.cached(timeout=60)
 def search_stale_prs():
-    issueQuery = ndb.AND(Issue.state == "open",
-                         Issue.updated_at < datetime.datetime.today() - datetime.timedelta(days=30))
-    stalePrs = Issue.query(issueQuery).order(-Issue.updated_at).fetch()
-    return search_prs(stalePrs)
+    return rendered_pr_list_response('stale')
+
+
+def search_all_open_prs():
+    return rendered_pr_list_response('open')
+
+
+@prs.route('/search-user-prs/<string:username>')
+def search_user_prs(username):
+    """
+    Returns a JSON object describing the open PRs that a GitHub user is involved in: `authored`
+    and `commented_on` list the PRs that they authored, or commented on without authoring, while
+    `lgtm` and `asked_to_close` list the numbers of the PRs where they said LGTM or asked for the
+    PR to be closed.
+    """
+    (body, etag) = get_user_prs_json(username)
+    return conditional_json_response(body, etag)
+
+
+@cache.memoize(timeout=60)
+def get_user_prs_json(username):
+    # The summaries' indexed `user` and `commenters` properties index the PRs by user, and they
+    # are kept up-to-date by the sync tasks, so this only loads the user's own PRs:
+    futures = [IssueSummary.query(IssueSummary.state == "open", prop == username)
+               .order(-IssueSummary.updated_at).fetch_async()
+               for prop in (IssueSummary.user, IssueSummary.commenters)]
+    (authored, commented) = [future.get_result() for future in futures]
+    authored_numbers = set(pr.number for pr in authored)
+    commented_on = [pr for pr in commented if pr.number not in authored_numbers]
+    rows = search_prs(authored + commented_on)
+    user_prs = {
+        'authored': rows[:len(authored)],
+        'commented_on': rows[len(authored):],
+        'lgtm': [],
+        'asked_to_close': [],
+    }
+    for row in rows:
+        for commenter in row['commenters']:
+            if commenter['username'] == username:
+                if commenter['data']['said_lgtm']:
+                    user_prs['lgtm'].append(row['number'])
+                if commenter['data']['asked_to_close']:
+                    user_prs['asked_to_close'].append(row['number'])
+    body = json.dumps(user_prs)
+    return (body, hashlib.md5(body).hexdigest())
+
+
+def get_open_prs_query():
+    return IssueSummary.query(IssueSummary.state == "open").order(-IssueSummary.updated_at)
+
+
+def get_stale_cutoff():
+    """
+    Returns the update time before which open PRs are stale.  It's rounded down to the hour so
+    that the stale list only changes hourly when nothing is written.
+    """
+    return (datetime.datetime.utcnow() - datetime.timedelta(days=app.config['DAYS_STALE'])) \
+        .replace(minute=0, second=0, microsecond=0)
+
+
+def get_stale_prs_query():
+    return IssueSummary.query(IssueSummary.state == "open",
+                              IssueSummary.updated_at < get_stale_cutoff()) \
+        .order(-IssueSummary.updated_at)
+
+
+# The lists that are pre-rendered by render_pr_list, and the functions that return their queries:
+PR_LIST_QUERIES = {
+    'open': get_open_prs_query,
+    'stale': get_stale_prs_query,
+}
+
+
+def rendered_pr_list_response(name):
+    """
+    Serves a pre-rendered PR list, with stale-while-revalidate semantics: if the rendering is
+    older than RENDERED_LIST_MAX_AGE then it's still served, but a task is enqueued to re-render
+    it.  The list is only queried during the request if it has never been rendered.
+    """
+    rendered = get_rendered_pr_list(name)
+    if rendered is None or \
+            datetime.datetime.utcnow() - rendered['rendered_at'] > RENDERED_LIST_MAX_AGE:
+        enqueue_render_pr_list(name)
+    if rendered is None:
+        # PRs become stale without any writes, so the stale list also changes with its cutoff:
+        etag_key = (name, get_stale_cutoff()) if name == 'stale' else (name,)
+        return streaming_json_response(PR_LIST_QUERIES[name](), etag_key)
+    # App Engine strips the Content-Encoding header from responses, so the stored gzipped body
+    # can't be served as-is; the front end compresses the response for clients that accept it.
+    return conditional_json_response(zlib.decompress(rendered['gzip_body'], 16 + zlib.MAX_WBITS),
+                                     rendered['etag'], {'X-PR-Version': rendered['version']})
+
+
+def conditional_json_response(body, etag, headers=None):
+    """
+    Returns a JSON response with the given ETag, or a 304 response if the request's
+    If-None-Match header matches it.  `body` may be a generator, in which case it's only consumed
+    if the full response is sent.
+    """
+    response = Response(body, mimetype='application/json', headers=headers)
+    response.set_etag(etag)
+    # Let browsers cache the response, but make them revalidate it (getting a 304 if it's
+    # unchanged):
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def get_rendered_pr_list(name):
+    """
+    Returns the latest rendering of a PR list as a dict with `gzip_body`, `etag`, `version` and
+    `rendered_at` keys, or None if it hasn't been rendered.  Renderings are looked up in an
+    in-process LRU cache, then in memcache and finally in the datastore.
+    """
+    now = time.time()
+    with _rendered_lists_lock:
+        cached = _rendered_lists.pop(name, None)
+        if cached is not None and now - cached[0] < IN_PROCESS_CACHE_TTL:
+            _rendered_lists[name] = cached
+            return cached[1]
+    memcache_key = RENDERED_LIST_MEMCACHE_PREFIX + name
+    rendered = memcache.get(memcache_key)
+    if rendered is None:
+        entity = RenderedPRList.get_by_id(name)
+        if entity is not None:
+            rendered = entity.to_dict()
+            memcache.add(memcache_key, rendered)
+    if rendered is not None:
+        with _rendered_lists_lock:
+            _rendered_lists[name] = (now, rendered)
+            while len(_rendered_lists) > IN_PROCESS_CACHE_SIZE:
+                _rendered_lists.popitem(last=False)
+    return rendered
+
+
+def enqueue_render_pr_list(name):
+    # Name the task after the current revalidation period, so that each list is only re-rendered
+    # once per period no matter how many requests see its stale rendering:
+    period = int(time.time() // RENDERED_LIST_MAX_AGE.total_seconds())
+    if _render_periods.get(name) == period:
+        return
+    _render_periods[name] = period
+    try:
+        taskqueue.add(url=url_for('tasks.render_pr_list', name=name),
+                      name='render-pr-list-%s-%i' % (name, period))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def render_pr_list(name):
+    """
+    Renders a PR list and stores it in memcache and the datastore.
+    """
+    version = datetime.datetime.utcnow().strftime(VERSION_FORMAT)
+    body = ''.join(stream_prs_json(PR_LIST_QUERIES[name]()))
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    rendered = {
+        'gzip_body': compressor.compress(body) + compressor.flush(),
+        'etag': hashlib.md5(body).hexdigest(),
+        'version': version,
+        'rendered_at': datetime.datetime.utcnow(),
+    }
+    try:
+        RenderedPRList(id=name, **rendered).put()
+    except BadRequestError:
+        # Entities are limited to 1 MB; until the list shrinks, it's only cached in memcache (if
+        # it fits there) and otherwise streamed by each request.
+        logging.warning("Rendered %s PR list is too large for the datastore" % name)
+    try:
+        memcache.set(RENDERED_LIST_MEMCACHE_PREFIX + name, rendered)
+    except ValueError:
+        logging.warning("Rendered %s PR list is too large for memcache" % name)
+    with _rendered_lists_lock:
+        _rendered_lists.pop(name, None)
+    return rendered
+
+
+def streaming_json_response(query, etag_key):
+    """
+    Returns a response that streams the list of PRs matching `query`.  The list's ETag is derived
+    from `etag_key` and the time of the latest write that could have changed it, so unchanged
+    lists can be revalidated without running the query.
+    """
+    version = datetime.datetime.utcnow().strftime(VERSION_FORMAT)
+    etag = hashlib.md5(repr(etag_key + get_latest_write_times())).hexdigest()
+    return conditional_json_response(stream_prs_json(query), etag, {'X-PR-Version': version})
+
+
+def get_latest_write_times():
+    """
+    Returns the times of the latest writes to any PR summary and any JIRA issue.  A PR's row in
+    the list can only change when one of these does, including when it's closed.
+    """
+    latest = []
+    for model in (IssueSummary, JIRAIssue):
+        entity = model.query().order(-model.modified_at).get(projection=[model.modified_at])
+        latest.append(entity.modified_at if entity else None)
+    return tuple(latest)
+
+
+def stream_prs_json(query):
+    """
+    Generates the JSON list of the PRs matching `query` in chunks.  Summaries are loaded, joined
+    with their JIRAs and serialized one batch at a time, so the first chunk is produced before
+    the last summary is loaded and the whole list is never held in memory at once.
+    """
+    yield '['
+    separator = ''
+    for batch in chunked(query.iter(batch_size=STREAM_BATCH_SIZE), STREAM_BATCH_SIZE):
+        yield separator + ', '.join(json.dumps(d) for d in search_prs(batch))
+        separator = ', '
+    yield ']'
+
+
+def search_filtered_prs():
+    """
+    Returns a JSON list of one page of the open PRs that match all of the given filters:
+
+    - `component`, `author`, `commenter`, `jenkins_outcome`, `jira_priority` and
+      `jira_target_version` match PRs with that value; they may be repeated.
+    - `stale=true` only matches PRs that haven't been updated in DAYS_STALE days.  It can only be
+      combined with `sort=updated_at`.
+    - `sort` is one of `updated_at` or `number`, optionally prefixed with `-` to sort in
+      descending order.  Defaults to `-updated_at`.
+    - `page_size` is the number of PRs to return, up to MAX_PAGE_SIZE.
+
+    If there are more matching PRs, the X-Next-Cursor header holds a value that can be passed as
+    `cursor` to fetch the next page.
+    """
+    args = tuple(sorted(request.args.items(multi=True)))
+    (body, etag, next_cursor) = get_filtered_prs_json(args)
+    return conditional_json_response(body, etag,
+                                     {'X-Next-Cursor': next_cursor} if next_cursor else None)
+
+
+@cache.memoize(timeout=60)
+def get_filtered_prs_json(args):
+    """
+    Returns a (body, etag, next cursor) tuple for a page of filtered PRs, given the request's
+    query parameters as a sorted tuple of (name, value) pairs.
+    """
+    params = ImmutableMultiDict(args)
+    query = IssueSummary.query(IssueSummary.state == "open")
+    for (param, prop) in FILTER_PARAMS:
+        for value in params.getlist(param):
+            query = query.filter(prop == value)
+    sort = params.get('sort', '-updated_at')
+    stale = params.get('stale') == 'true'
+    if sort not in SORT_ORDERS or (stale and sort != 'updated_at'):
+        return abort(400)
+    try:
+        page_size = min(int(params.get('page_size', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        cursor = Cursor(urlsafe=params.get('cursor'))
+    except (ValueError, BadValueError):
+        return abort(400)
+    if page_size < 1:
+        return abort(400)
+    (prs, next_cursor, more) = query.order(SORT_ORDERS[sort]) \
+        .fetch_page(page_size, start_cursor=cursor)
+    if stale:
+        # Filtering on updated_at would need a composite index for every combination of the other
+        # filters, so instead rely on stale PRs being a prefix of the list in this sort order:
+        cutoff = get_stale_cutoff()
+        stale_prs = list(itertools.takewhile(lambda pr: pr.updated_at < cutoff, prs))
+        more = more and len(stale_prs) == len(prs)
+        prs = stale_prs
+    body = json.dumps(search_prs(prs))
+    return (body, hashlib.md5(body).hexdigest(),
+            next_cursor.urlsafe() if more and next_cursor else None)
+
+
+def search_open_prs_delta(since):
+    try:
+        since = datetime.datetime.strptime(since, VERSION_FORMAT) - DELTA_OVERLAP
+    except ValueError:
+        return abort(400)
+    version = datetime.datetime.utcnow().strftime(VERSION_FORMAT)
+    changed_prs = {}
+    for pr in IssueSummary.query(IssueSummary.modified_at > since).fetch():
+        changed_prs[pr.number] = pr
+    # Open PRs also need to be re-sent if any of their JIRAs have changed:
+    changed_jira_ids = [key.id() for key in
+                        JIRAIssue.query(JIRAIssue.modified_at > since).fetch(keys_only=True)]
+    changed_jiras = [int(jira_id.split('-')[-1]) for jira_id in changed_jira_ids]
+    futures = [IssueSummary.query(IssueSummary.state == "open", IssueSummary.jiras.IN(jiras))
+               .fetch_async() for jiras in chunked(changed_jiras, 30)]
+    for future in futures:
+        for pr in future.get_result():
+            changed_prs[pr.number] = pr
+    open_prs = sorted((pr for pr in changed_prs.values() if pr.state == "open"),
+                      key=lambda pr: pr.updated_at, reverse=True)
+    delta = {
+        'version': version,
+        'prs': search_prs(open_prs),
+        'removed': [pr.number for pr in changed_prs.values() if pr.state != "open"],
+    }
+    return Response(json.dumps(delta), mimetype='application/json')
 
 
 def search_prs(prs):
+    """
+    Returns the JSON dicts for a list of `IssueSummary` entities, joining in information from
+    their JIRAs.
+    """
+    # Resolve every referenced JIRA in a single batch get rather than one lookup per PR:
+    jira_numbers = list(set(itertools.chain.from_iterable(
+        pr.summary_json['parsed_title']['jiras'] for pr in prs)))
+    jira_keys = [ndb.Key("JIRAIssue", "%s-%i" % (app.config['JIRA_PROJECT'], n))
+                 for n in jira_numbers]
+    jiras_by_number = dict(zip(jira_numbers, ndb.get_multi(jira_keys)))
     json_dicts = []
     for pr in prs:
         try:
-            last_jenkins_comment_dict = None
-            if pr.last_jenkins_comment:
-                last_jenkins_comment_dict = {
-                    'body': pr.last_jenkins_comment['body'],
-                    'user': {'login': pr.last_jenkins_comment['user']['login']},
-                    'html_url': pr.last_jenkins_comment['html_url'],
-                    'date': [pr.last_jenkins_comment['created_at']],
-                }
-            d = {
-                'parsed_title': pr.parsed_title,
-                'number': pr.number,
-                'updated_at': str(pr.updated_at),
-                'user': pr.user,
-                'state': pr.state,
-                'components': pr.components,
-                'lines_added': pr.lines_added,
-                'lines_deleted': pr.lines_deleted,
-                'lines_changed': pr.lines_changed,
-                'is_mergeable': pr.is_mergeable,
-                'commenters': [
-                    {
-                        'username': u,
-                        'data': d,
-                        'is_committer': u in app.config.get('COMMITTER_GITHUB_USERNAMES', []),
-                    } for (u, d) in pr.commenters],
-                'last_jenkins_outcome': pr.last_jenkins_outcome,
-                'last_jenkins_comment': last_jenkins_comment_dict,
-            }
+            d = dict(pr.summary_json)
             # Use the first JIRA's information to populate the "Priority" and "Issue Type" columns:
-            jiras = pr.parsed_title["jiras"]
+            jiras = d['parsed_title']["jiras"]
             if jiras:
                 d['closed_jiras'] = []
-                first_jira = JIRAIssue.get_by_id("%s-%i" % (app.config['JIRA_PROJECT'], jiras[0]))
+                first_jira = jiras_by_number[jiras[0]]
                 if first_jira:
                     d['jira_priority_name'] = first_jira.priority_name
                     d['jira_priority_icon_url'] = first_jira.priority_icon_url
@@ -77,7 +420,7 @@ def search_prs(prs):
                 # versions should be union of the individual issues' target versions:
                 target_versions = set()
                 for jira_number in jiras:
-                    jira = JIRAIssue.get_by_id("%s-%i" % (app.config['JIRA_PROJECT'], jira_number))
+                    jira = jiras_by_number[jira_number]
                     if jira:
                         target_versions.update(jira.target_versions)
                         if jira.is_closed:
@@ -88,5 +431,4 @@ def search_prs(prs):
         except:
             logging.error("Exception while processing PR #%i", pr.number)
             raise
-    response = Response(json.dumps(json_dicts), mimetype='application/json')
-    return response
+    return json_dicts
@@ -1,23 +1,28 @@
 from datetime import datetime
 from urllib2 import HTTPError
+import hashlib
 import itertools
 import json
 import logging
-import re
 
-from flask import Blueprint, url_for
+from flask import Blueprint, Response, url_for, request, abort
 from google.appengine.api import taskqueue
-import feedparser
-from link_header import parse as parse_link_header
+from google.appengine.datastore.datastore_query import Cursor
+import google.appengine.ext.ndb as ndb
 from dateutil.parser import parse as parse_datetime
 from dateutil import tz
-from more_itertools import chunked
 
-from sparkprs.models import Issue, JIRAIssue, KVS
+from sparkprs.models import Issue, JIRAIssue, KVS, BotCommentCleanup
 from sparkprs.github_api import raw_github_request, paginated_github_request, get_pulls_base, \
-    get_issues_base
+    get_issues_base, iter_github_pages, get_rate_limit_wait_time, GitHubRateLimitExceeded, \
+    BASE_URL, PAGE_SIZE, delete_github_resources
+from sparkprs.github_graphql import fetch_pull_request
+from sparkprs.controllers.prs import PR_LIST_QUERIES, render_pr_list as render_pr_list_json
 from sparkprs import app
-from sparkprs.jira_api import start_issue_progress, link_issue_to_pr
+from sparkprs.task_queues import enqueue_tasks, task_name
+from sparkprs.utils import prune_json, analyze_github_comment, advance_jira_watermark
+from sparkprs.jira_api import start_issue_progress, link_issue_to_pr, search_issues, \
+    is_permanent_error
 
 
 tasks = Blueprint('tasks', __name__)
@@ -25,6 +30,57 @@ tasks = Blueprint('tasks', __name__)
 
 oauth_token = app.config['GITHUB_OAUTH_KEY']
 
+# The number of issues to request per page of JIRA search results (the most that JIRA returns):
+JIRA_SEARCH_PAGE_SIZE = 100
+
+# The fields of GitHub's JSON that we store for each issue; everything else, such as the files'
+# patches and the users' profile URLs, is dropped at ingest to keep Issue entities small.  These
+# match the shapes of the JSON that github_graphql produces.
+USER_SCHEMA = {'login': None, 'avatar_url': None}
+PR_SCHEMA = {
+    'number': None, 'title': None, 'state': None, 'merged': None, 'mergeable': None,
+    'additions': None, 'deletions': None, 'created_at': None, 'updated_at': None,
+    'html_url': None, 'user': USER_SCHEMA, 'head': {'sha': None}, 'base': {'ref': None},
+}
+COMMENT_SCHEMA = {
+    'id': None, 'url': None, 'html_url': None, 'body': None, 'created_at': None,
+    'updated_at': None, 'user': USER_SCHEMA,
+}
+REVIEW_COMMENT_SCHEMA = dict(COMMENT_SCHEMA, diff_hunk=None)
+FILE_SCHEMA = {'filename': None, 'additions': None, 'deletions': None}
+
+# Task queues whose tasks yield the GitHub rate limit to fresher work when it runs low:
+LOW_PRIORITY_QUEUES = ('old-prs',)
+
+
+@tasks.before_request
+def defer_low_priority_tasks():
+    """
+    Defers tasks from low-priority queues while fewer than GITHUB_RATE_LIMIT_RESERVE requests
+    remain in our GitHub rate limit, so that backfills and bulk refreshes can't starve the
+    fresh-prs queue and the update cron.  The error status makes the task queue retry the task
+    later, with backoff.
+    """
+    if request.headers.get('X-AppEngine-QueueName') in LOW_PRIORITY_QUEUES:
+        # In GraphQL mode, the PR updates use the GraphQL budget, and the backfills the REST one:
+        resources = ['core']
+        if app.config.get('GITHUB_SYNC_MODE', 'rest') == 'graphql':
+            resources.append('graphql')
+        wait_time = max(get_rate_limit_wait_time(oauth_token, resource=resource,
+                                                 reserve=app.config['GITHUB_RATE_LIMIT_RESERVE'])
+                        for resource in resources)
+        if wait_time > 0:
+            logging.info("Deferring low-priority task; GitHub rate limit resets in %i seconds" %
+                         wait_time)
+            return Response("Deferred until the GitHub rate limit resets", status=503,
+                            headers={'Retry-After': str(wait_time)})
+
+
+@tasks.errorhandler(GitHubRateLimitExceeded)
+def handle_github_rate_limit(e):
+    logging.warning(str(e))
+    return Response(str(e), status=503, headers={'Retry-After': str(e.retry_after)})
+
 
 @tasks.route("/github/backfill-prs")
 def backfill_prs():
@@ -38,25 +94,87 @@ def backfill_prs():
     response = raw_github_request(url, oauth_token=oauth_token)
     latest_prs = json.loads(response.content)
     latest_pr_number = int(latest_prs[0]['number'])
-    queue = taskqueue.Queue('old-prs')
-    update_tasks = []
-    for num in reversed(xrange(1, latest_pr_number + 1)):
-        update_tasks.append(taskqueue.Task(url=url_for(".update_pr", pr_number=num)))
-    # Can only enqueue up to 100 tasks per API call
-    async_call_results = []
-    for group_of_tasks in chunked(update_tasks, 100):
-        async_call_results.append(queue.add_async(group_of_tasks))
-    # Block until the async calls are finished:
-    for r in async_call_results:
-        r.get_result()
+    update_tasks = [update_pr_task(num) for num in reversed(xrange(1, latest_pr_number + 1))]
+    enqueue_tasks(update_tasks, queue_name='old-prs')
     return "Enqueued tasks to backfill %i PRs" % latest_pr_number
 
 
+def update_pr_task(pr_number, *name_parts):
+    """
+    Returns a task that updates a pull request.  If `name_parts` are given, the task is named after
+    them and the PR number, so that adding another task for the same update is a no-op; pass the
+    PR's `updated_at` time to update each PR at most once per GitHub update.
+    """
+    name = None
+    if name_parts:
+        name = task_name('update-pr', pr_number, *[
+            p.strftime("%Y%m%dT%H%M%S") if isinstance(p, datetime) else p for p in name_parts])
+    return taskqueue.Task(url=url_for(".update_pr", pr_number=pr_number), name=name)
+
+
+@tasks.route("/github/backfill-prs-from-list", methods=['GET', 'POST'])
+def backfill_prs_from_list():
+    """
+    A faster alternative to backfill_prs, which seeds issues directly from pages of GitHub's list
+    of pull requests (100 PRs per request) instead of fetching each PR individually.  Each task
+    processes one page, newest PRs first, and then enqueues a task for the next page.
+
+    The list doesn't include the PRs' line counts or mergeability, so open PRs are enqueued for a
+    full update, which also fetches their comments and files.  Closed PRs aren't shown on the
+    dashboard, so their details are only fetched if they're updated later.
+
+    Each backfill is identified by the time that it was started, which is passed along to the
+    next pages' tasks and included in their names, so a backfill can be run again before the
+    previous run's task names expire.
+    """
+    page = int(request.args.get('page', 1))
+    run = request.args.get('run') or datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    url = get_pulls_base() + "?sort=created&state=all&direction=desc&per_page=%i&page=%i" % \
+        (PAGE_SIZE, page)
+    pr_jsons = json.loads(raw_github_request(url, oauth_token=oauth_token).content)
+    existing_issues = ndb.get_multi([ndb.Key("Issue", str(pr['number'])) for pr in pr_jsons])
+    issues = []
+    for (pr_json, issue) in zip(pr_jsons, existing_issues):
+        updated_at = \
+            parse_datetime(pr_json['updated_at']).astimezone(tz.tzutc()).replace(tzinfo=None)
+
+        def is_up_to_date(issue):
+            # If so, the issue may have more details than the list has, so leave it alone:
+            return issue is not None and issue.pr_json and issue.updated_at >= updated_at
+
+        def seed(issue):
+            if is_up_to_date(issue):
+                return False
+            set_pr_json(issue, pr_json)
+        # Skip up-to-date issues without a transaction, and check again within it in case the
+        # issue has been updated since:
+        if is_up_to_date(issue):
+            continue
+        issue = update_issue(pr_json['number'], seed)
+        if issue is not None:
+            issues.append(issue)
+    update_tasks = [update_pr_task(issue.number, issue.updated_at)
+                    for issue in issues if issue.state == "open"]
+    if len(pr_jsons) == PAGE_SIZE:
+        update_tasks.append(taskqueue.Task(
+            url=url_for(".backfill_prs_from_list", page=page + 1, run=run),
+            name=task_name('backfill-prs-from-list', run, page + 1)))
+    enqueue_tasks(update_tasks, queue_name='old-prs')
+    # The updates won't see any changes to the open PRs' JIRAs, so link them here:
+    enqueue_tasks([link_jiras_task(issue) for issue in issues
+                   if issue.state == "open" and issue.parsed_title['jiras']],
+                  queue_name='jira-links')
+    return "Seeded %i PRs from page %i and enqueued updates for %i open PRs" % \
+        (len(issues), page, len(update_tasks))
+
+
 @tasks.route("/github/refresh-all-prs")
 def refresh_all_prs():
-    prs = Issue.query(Issue.state == "open")
-    for pr in prs:
-        taskqueue.add(url=url_for(".update_pr", pr_number=pr.number), queue_name='old-prs')
+    # Each open PR is refreshed at most once per day, however often this is invoked:
+    today = datetime.utcnow().strftime("%Y%m%d")
+    pr_keys = Issue.query(Issue.state == "open").fetch(keys_only=True)
+    enqueue_tasks([update_pr_task(int(key.id()), 'refresh', today) for key in pr_keys],
+                  queue_name='old-prs')
     return "Enqueued tasks to refresh all open PRs"
 
 
@@ -74,14 +192,15 @@ def update_github_prs():
         last_update_time = datetime.min
         KVS.put('issues_since', datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"))
 
-    def fetch_and_process(url):
-        logging.debug("Following url %s" % url)
-        response = raw_github_request(url, oauth_token=oauth_token)
-        prs = json.loads(response.content)
-        now = datetime.utcnow()
+    # Walk the list of PRs, most recently updated first, until we reach the watermark. Only a
+    # few pages are usually needed, so ramp up the number of concurrent page fetches gradually:
+    url = get_pulls_base() + "?sort=updated&state=all&direction=desc&per_page=100"
+    now = datetime.utcnow()
+    update_time = last_update_time
+    for response in iter_github_pages(url, oauth_token=oauth_token, ramp_up=True):
         should_continue_loading = True
-        update_time = last_update_time
-        for pr in prs:
+        update_tasks = {"fresh-prs": [], "old-prs": []}
+        for pr in response.json():
             updated_at = \
                 parse_datetime(pr['updated_at']).astimezone(tz.tzutc()).replace(tzinfo=None)
             update_time = max(update_time, updated_at)
@@ -90,21 +209,34 @@ def update_github_prs():
                 break
             is_fresh = (now - updated_at).total_seconds() < app.config['FRESHNESS_THRESHOLD']
             queue_name = ("fresh-prs" if is_fresh else "old-prs")
-            taskqueue.add(url=url_for(".update_pr", pr_number=pr['number']), queue_name=queue_name)
-        if should_continue_loading:
-            link_header = parse_link_header(response.headers.get('Link', ''))
-            for link in link_header.links:
-                if link.rel == 'next':
-                    fetch_and_process(link.href)
-        return update_time
-    update_time = \
-        fetch_and_process(get_pulls_base() + "?sort=updated&state=all&direction=desc&per_page=100")
+            update_tasks[queue_name].append(update_pr_task(pr['number'], updated_at))
+        for (queue_name, queue_tasks) in update_tasks.items():
+            enqueue_tasks(queue_tasks, queue_name=queue_name)
+        if not should_continue_loading:
+            break
     KVS.put('issues_since', update_time.strftime("%Y-%m-%dT%H:%M:%SZ"))
+    # Re-render the PR lists once the PR updates that we just enqueued have had a chance to run:
+    enqueue_tasks([taskqueue.Task(url=url_for(".render_pr_list", name=name), countdown=60)
+                   for name in PR_LIST_QUERIES])
     return "Done fetching updated GitHub issues"
 
 
+@tasks.route("/github/update-prs-for-commit/<string:sha>", methods=['GET', 'POST'])
+def update_prs_for_commit(sha):
+    """
+    Updates the pull requests that contain a commit; used to handle push webhook events.
+    """
+    url = BASE_URL + "repos/%s/commits/%s/pulls" % (app.config['GITHUB_PROJECT'], sha)
+    prs = json.loads(raw_github_request(url, oauth_token=oauth_token).content)
+    update_tasks = [update_pr_task(pr['number'], parse_datetime(pr['updated_at'])) for pr in prs]
+    enqueue_tasks(update_tasks, queue_name='fresh-prs')
+    return "Enqueued tasks to update %i PRs containing commit %s" % (len(prs), sha)
+
+
 @tasks.route("/github/update-pr/<int:pr_number>", methods=['GET', 'POST'])
 def update_pr(pr_number):
+    if app.config.get('GITHUB_SYNC_MODE', 'rest') == 'graphql':
+        return update_pr_graphql(pr_number)
     logging.debug("Updating pull request %i" % pr_number)
     pr = Issue.get_or_create(pr_number)
     try:
@@ -113,137 +245,417 @@ def update_pr(pr_number):
     except HTTPError as e:
         if e.code == 404:
             logging.debug("Pull request %i has been deleted" % pr_number)
-            pr.state = "deleted"
-            pr.put()
+            update_issue(pr_number, mark_pr_deleted)
             return "Done updating pull request %i (PR deleted)" % pr_number
         else:
             raise
     if issue_response is None:
         logging.debug("PR %i hasn't changed since last visit; skipping" % pr_number)
         return "Done updating pull request %i (nothing changed)" % pr_number
-    pr.pr_json = json.loads(issue_response.content)
-    pr.etag = issue_response.headers["ETag"]
+    pr_json = json.loads(issue_response.content)
+
+    def update(pr):
+        previous_jira_link_state = get_jira_link_state(pr)
+        set_pr_json(pr, pr_json)
+        pr.etag = issue_response.headers["ETag"]
+        if get_jira_link_state(pr) != previous_jira_link_state:
+            enqueue_link_jiras(pr, transactional=True)
+    pr = update_issue(pr_number, update)
+
+    # The subtasks are named after the PR's update time, so each update is only fetched once:
+    subtasks = [".update_pr_comments", ".update_pr_review_comments", ".update_pr_files"]
+    enqueue_tasks([taskqueue.Task(url=url_for(task, pr_number=pr_number),
+                                  name=task_name(task.strip('.'), pr_number,
+                                                 pr.updated_at.strftime("%Y%m%dT%H%M%S")))
+                   for task in subtasks], queue_name='fresh-prs')
+
+    return "Done updating pull request %i" % pr_number
+
+
+def update_pr_graphql(pr_number):
+    """
+    Updates a pull request along with its comments, review comments and files using one GraphQL
+    query (plus continuation queries for long lists) and a single datastore write, instead of
+    the REST requests and writes made by update_pr and its three subtasks.
+
+    Enabled by setting GITHUB_SYNC_MODE to 'graphql'.
+    """
+    logging.debug("Updating pull request %i using GraphQL" % pr_number)
+    pr = Issue.get_or_create(pr_number)
+    pull_request = fetch_pull_request(pr_number, oauth_token=oauth_token)
+    if pull_request is None:
+        logging.debug("Pull request %i has been deleted" % pr_number)
+        update_issue(pr_number, mark_pr_deleted)
+        return "Done updating pull request %i (PR deleted)" % pr_number
+    pr.load_data()
+    if all(getattr(pr, field) == value for (field, value) in pull_request.items()):
+        logging.debug("PR %i hasn't changed since last visit; skipping" % pr_number)
+        return "Done updating pull request %i (nothing changed)" % pr_number
+
+    def update(pr):
+        previous_jira_link_state = get_jira_link_state(pr)
+        set_pr_json(pr, pull_request['pr_json'])
+        if get_jira_link_state(pr) != previous_jira_link_state:
+            enqueue_link_jiras(pr, transactional=True)
+        pr.comments_json = pull_request['comments_json']
+        pr.pr_comments_json = pull_request['pr_comments_json']
+        pr.files_json = pull_request['files_json']
+        # GraphQL responses don't have ETags, so clear the REST ones to force a full refresh if
+        # the REST sync mode is re-enabled.  files_etag also keys the components cache, so base
+        # it on the file names instead:
+        (pr.etag, pr.comments_etag, pr.pr_comments_etag) = (None, None, None)
+        pr.files_etag = \
+            hashlib.sha1(json.dumps([f['filename'] for f in pr.files_json])).hexdigest()
+        pr.cached_commenters = pr._compute_commenters()
+        pr.cached_last_jenkins_outcome = None  # Recomputed when the summary is written
+    pr = update_issue(pr_number, update)
+
+    enqueue_bot_comment_cleanup(pr)
+    return "Done updating pull request %i" % pr_number
+
+
+def update_issue(pr_number, update):
+    """
+    Applies `update`, a function that modifies an `Issue`, to a pull request's issue, and then
+    writes the issue, the IssueData children that `update` assigned and the refreshed summary in
+    a cross-group transaction.  The transaction is retried if a concurrent task modifies the
+    issue, so the sync tasks for the same pull request never overwrite each other's changes;
+    `update` may therefore run more than once, and shouldn't have any other side effects, apart
+    from adding transactional tasks.  If `update` returns False, nothing is written.
+
+    :return: the updated issue, or None if `update` returned False.
+    """
+    @ndb.transactional(xg=True)
+    def update_in_transaction():
+        pr = Issue.get(pr_number) or Issue(id=str(pr_number), number=pr_number)
+        if update(pr) is False:
+            return None
+        pr.put_with_summary()
+        return pr
+    return update_in_transaction()
+
+
+def mark_pr_deleted(pr):
+    pr.state = "deleted"
+
+
+def set_pr_json(pr, pr_json):
+    pr.pr_json = prune_json(pr_json, PR_SCHEMA)
     pr.state = pr.pr_json['state']
     pr.user = pr.pr_json['user']['login']
     pr.updated_at = \
         parse_datetime(pr.pr_json['updated_at']).astimezone(tz.tzutc()).replace(tzinfo=None)
 
+
+def get_jira_link_state(pr):
+    """
+    Returns the parts of a pull request that its JIRA links and transitions depend on.
+    """
+    return (pr.parsed_title['jiras'], pr.state)
+
+
+def link_jiras_task(pr):
+    return taskqueue.Task(url=url_for(".link_jiras", pr_number=pr.number))
+
+
+def enqueue_link_jiras(pr, transactional=False):
+    """
+    Enqueues a task to link a pull request's JIRAs to it, if it references any.  Pass
+    `transactional=True` from an issue update (see update_issue) to only enqueue the task if the
+    update is committed.
+    """
+    if pr.parsed_title['jiras'] and pr.state != "deleted":
+        link_jiras_task(pr).add(queue_name='jira-links', transactional=transactional)
+
+
+@tasks.route("/jira/link-pr/<int:pr_number>", methods=['GET', 'POST'])
+def link_jiras(pr_number):
+    """
+    Links the JIRAs that a pull request references to it, and starts their progress.  Runs on
+    the jira-links queue, so a slow JIRA doesn't hold up the PR's sync; it's enqueued whenever
+    the PR's referenced JIRAs or state change.
+
+    Links and transitions that are already done are recorded (see jira_api), so retrying this
+    task only retries the JIRAs that failed.  Only transient failures are retried; errors that
+    retrying won't fix, such as references to JIRAs that don't exist, are just logged.  The queue
+    runs one task at a time, so the same JIRA is never linked by two tasks at once.
+    """
+    if not app.config['JIRA_USERNAME']:
+        logging.warning("Not linking JIRAs to PR %i: JIRA credentials aren't set" % pr_number)
+        return "JIRA linking is disabled"
+    pr = Issue.get(pr_number)
+    failures = link_jiras_to_pr(pr)
+    if failures:
+        return Response("Failed to link %i JIRAs to PR %i" % (failures, pr_number), status=503)
+    return "Done linking JIRAs to PR %i" % pr_number
+
+
+def link_jiras_to_pr(pr):
+    """
+    :return: the number of links and progress transitions that failed transiently, and so are
+             worth retrying.
+    """
+    failures = 0
     for issue_number in pr.parsed_title['jiras']:
+        issue = "%s-%s" % (app.config['JIRA_PROJECT'], issue_number)
         try:
-            link_issue_to_pr("%s-%s" % (app.config['JIRA_PROJECT'], issue_number), pr)
-        except:
-            logging.exception("Exception when linking to JIRA issue %s-%s" %
-                              (app.config['JIRA_PROJECT'], issue_number))
+            link_issue_to_pr(issue, pr)
+        except Exception as e:
+            logging.exception("Exception when linking to JIRA issue %s" % issue)
+            if not is_permanent_error(e):
+                failures += 1
         try:
-            start_issue_progress("%s-%s" % (app.config['JIRA_PROJECT'], issue_number))
-        except:
-            logging.exception(
-                "Exception when starting progress on JIRA issue %s-%s" %
-                (app.config['JIRA_PROJECT'], issue_number))
-
-    pr.put()  # Write our modifications back to the database
+            start_issue_progress(issue, pr)
+        except Exception as e:
+            logging.exception("Exception when starting progress on JIRA issue %s" % issue)
+            if not is_permanent_error(e):
+                failures += 1
+    return failures
 
-    subtasks = [".update_pr_comments", ".update_pr_review_comments", ".update_pr_files"]
-    for task in subtasks:
-        taskqueue.add(url=url_for(task, pr_number=pr_number), queue_name='fresh-prs')
 
-    return "Done updating pull request %i" % pr_number
+def update_unsynced_pr(pr_number):
+    """
+    Enqueues a full update for a pull request that hasn't been synced yet, e.g. when a webhook
+    reports a comment on a new PR before its update has run.  The update's subtasks then fetch the
+    PR's comments, review comments and files.
+    """
+    enqueue_tasks([update_pr_task(pr_number, 'unsynced')], queue_name='fresh-prs')
+    return "PR %i hasn't been synced yet; enqueued an update" % pr_number
 
 
 @tasks.route("/github/update-pr-comments/<int:pr_number>", methods=['GET', 'POST'])
 def update_pr_comments(pr_number):
     pr = Issue.get(pr_number)
+    if pr is None:
+        return update_unsynced_pr(pr_number)
     comments_response = paginated_github_request(get_issues_base() + '/%i/comments' % pr_number,
-                                                 oauth_token=oauth_token)
-    # TODO: after fixing #32, re-enable etags here: etag=self.comments_etag)
+                                                 oauth_token=oauth_token, etag=pr.comments_etag)
     if comments_response is None:
         return "Comments for PR %i are up-to-date" % pr_number
     else:
-        pr.comments_json, pr.comments_etag = comments_response
-        pr.cached_commenters = pr._compute_commenters()
-        pr.cached_last_jenkins_outcome = None
-        pr.last_jenkins_outcome  # force recomputation of Jenkins outcome
-        pr.put()  # Write our modifications back to the database
-
-        # Delete out-of-date comments from AmplabJenkins and SparkQA.
-        jenkins_comment_to_preserve = pr.last_jenkins_comment
-        sparkqa_token = app.config["SPARKQA_GITHUB_OAUTH_KEY"]
-        amplabjenkins_token = app.config["AMPLAB_JENKINS_GITHUB_OAUTH_KEY"]
-        sparkqa_start_comments = {}  # Map from build ID to build start comment
-        build_start_regex = r"Test build #(\d+) has started"
-        build_end_regex = r"Test build #(\d+) (has finished|timed out)"
-        for comment in (pr.comments_json or []):
-            author = comment["user"]["login"]
-            # Delete all comments from AmplabJenkins unless they are the comments that should be
-            # displayed on the Spark PR dashboard. If we do not know which comment to preserve, then
-            # do not delete any comments from AmplabJenkins.
-            if jenkins_comment_to_preserve \
-                    and author == "AmplabJenkins" \
-                    and comment["url"] != jenkins_comment_to_preserve["url"]:
-                raw_github_request(comment["url"], oauth_token=amplabjenkins_token, method="DELETE")
-            elif author == "SparkQA":
-                # Only delete build start notification comments from SparkQA and only delete them
-                # after we've seen the corresponding build finished message.
-                start_regex_match = re.search(build_start_regex, comment["body"])
-                if start_regex_match:
-                    sparkqa_start_comments[start_regex_match.groups()[0]] = comment
-                else:
-                    end_regex_match = re.search(build_end_regex, comment["body"])
-                    if end_regex_match:
-                        start_comment = sparkqa_start_comments.get(end_regex_match.groups()[0])
-                        if start_comment:
-                            raw_github_request(start_comment["url"], oauth_token=sparkqa_token,
-                                               method="DELETE")
+        (comments_json, comments_etag) = comments_response
+        comments_json = prune_json(comments_json, COMMENT_SCHEMA)
+
+        def update(pr):
+            (pr.comments_json, pr.comments_etag) = (comments_json, comments_etag)
+            pr.cached_commenters = pr._compute_commenters()
+            pr.cached_last_jenkins_outcome = None  # Recomputed when the summary is written
+        pr = update_issue(pr_number, update)
+        enqueue_bot_comment_cleanup(pr)
         return "Done updating comments for PR %i" % pr_number
 
 
+def enqueue_bot_comment_cleanup(pr):
+    taskqueue.add(url=url_for(".delete_obsolete_bot_comments", pr_number=pr.number),
+                  queue_name='bot-comments')
+
+
+def find_obsolete_bot_comments(pr):
+    """
+    Returns the out-of-date comments from AmplabJenkins and SparkQA on a pull request.
+    """
+    jenkins_comment_to_preserve = pr.last_jenkins_comment
+    obsolete_comments = []
+    sparkqa_start_comments = {}  # Map from build ID to build start comment
+    for comment in (pr.comments_json or []):
+        author = comment["user"]["login"]
+        # Delete all comments from AmplabJenkins unless they are the comments that should be
+        # displayed on the Spark PR dashboard. If we do not know which comment to preserve, then
+        # do not delete any comments from AmplabJenkins.
+        if jenkins_comment_to_preserve \
+                and author == "AmplabJenkins" \
+                and comment["url"] != jenkins_comment_to_preserve["url"]:
+            obsolete_comments.append(comment)
+        elif author == "SparkQA":
+            # Only delete build start notification comments from SparkQA and only delete them
+            # after we've seen the corresponding build finished message.
+            analysis = analyze_github_comment(comment)
+            if analysis['started_build']:
+                sparkqa_start_comments[analysis['started_build']] = comment
+            elif analysis['ended_build']:
+                start_comment = sparkqa_start_comments.get(analysis['ended_build'])
+                if start_comment:
+                    obsolete_comments.append(start_comment)
+    return obsolete_comments
+
+
+@tasks.route("/github/delete-obsolete-bot-comments/<int:pr_number>", methods=['GET', 'POST'])
+def delete_obsolete_bot_comments(pr_number):
+    """
+    Deletes out-of-date comments from AmplabJenkins and SparkQA, using concurrent requests.
+
+    Deleted comments are recorded in the PR's BotCommentCleanup so later runs skip them.  If any
+    deletions fail transiently, the task fails so that the task queue retries it, and only the
+    comments that weren't deleted are attempted again.  Comments from bots whose tokens aren't
+    configured are left alone.
+    """
+    tokens = {
+        "AmplabJenkins": app.config["AMPLAB_JENKINS_GITHUB_OAUTH_KEY"],
+        "SparkQA": app.config["SPARKQA_GITHUB_OAUTH_KEY"],
+    }
+    pr = Issue.get(pr_number)
+    comments = [c for c in find_obsolete_bot_comments(pr) if tokens[c["user"]["login"]]]
+    if not comments:
+        return "No obsolete bot comments to delete on PR %i" % pr_number
+    # Only load the record once there's something to delete, so most syncs don't touch it:
+    cleanup = BotCommentCleanup.get_by_id(str(pr_number)) or \
+        BotCommentCleanup(id=str(pr_number))
+    deleted_ids = set(cleanup.deleted_comment_ids)
+    comments = [c for c in comments if c["id"] not in deleted_ids]
+    if not comments:
+        return "No obsolete bot comments to delete on PR %i" % pr_number
+    (deleted_urls, failed_urls) = (set(), set())
+    for (author, token) in tokens.items():
+        urls = [c["url"] for c in comments if c["user"]["login"] == author]
+        if urls:
+            (deleted, failed) = delete_github_resources(urls, oauth_token=token)
+            deleted_urls.update(deleted)
+            failed_urls.update(failed)
+    newly_deleted_ids = set(c["id"] for c in comments if c["url"] in deleted_urls)
+    if newly_deleted_ids:
+        # Forget comments that are no longer on the PR, so that the record doesn't grow forever:
+        current_ids = set(c["id"] for c in pr.comments_json)
+        cleanup.deleted_comment_ids = sorted((deleted_ids & current_ids) | newly_deleted_ids)
+        cleanup.put()
+    failures = len(failed_urls)
+    if failures:
+        return Response("Failed to delete %i of %i obsolete bot comments on PR %i" %
+                        (failures, len(comments), pr_number), status=503)
+    return "Deleted %i of %i obsolete bot comments on PR %i" % \
+        (len(newly_deleted_ids), len(comments), pr_number)
+
+
 @tasks.route("/github/update-pr-review-comments/<int:pr_number>", methods=['GET', 'POST'])
 def update_pr_review_comments(pr_number):
     pr = Issue.get(pr_number)
+    if pr is None:
+        return update_unsynced_pr(pr_number)
     pr_comments_response = paginated_github_request(get_pulls_base() + '/%i/comments' % pr_number,
-                                                    oauth_token=oauth_token)
-    # TODO: after fixing #32, re-enable etags here: etag=self.pr_review_comments_etag)
+                                                    oauth_token=oauth_token,
+                                                    etag=pr.pr_comments_etag)
     if pr_comments_response is None:
         return "Review comments for PR %i are up-to-date" % pr_number
     else:
-        pr.pr_comments_json, pr.pr_comments_etag = pr_comments_response
-        pr.cached_commenters = pr._compute_commenters()
-        pr.put()  # Write our modifications back to the database
+        (pr_comments_json, pr_comments_etag) = pr_comments_response
+        pr_comments_json = prune_json(pr_comments_json, REVIEW_COMMENT_SCHEMA)
+
+        def update(pr):
+            (pr.pr_comments_json, pr.pr_comments_etag) = (pr_comments_json, pr_comments_etag)
+            pr.cached_commenters = pr._compute_commenters()
+        update_issue(pr_number, update)
         return "Done updating review comments for PR %i" % pr_number
 
 
 @tasks.route("/github/update-pr-files/<int:pr_number>", methods=['GET', 'POST'])
 def update_pr_files(pr_number):
     pr = Issue.get(pr_number)
+    if pr is None:
+        return update_unsynced_pr(pr_number)
     files_response = paginated_github_request(get_pulls_base() + "/%i/files" % pr_number,
                                               oauth_token=oauth_token, etag=pr.files_etag)
     if files_response is None:
         return "Files for PR %i are up-to-date" % pr_number
     else:
-        pr.files_json, pr.files_etag = files_response
-        pr.put()  # Write our modifications back to the database
+        (files_json, files_etag) = files_response
+        files_json = prune_json(files_json, FILE_SCHEMA)
+
+        def update(pr):
+            (pr.files_json, pr.files_etag) = (files_json, files_etag)
+        update_issue(pr_number, update)
         return "Done updating files for PR %i" % pr_number
 
 
+@tasks.route("/rebuild-issue-summaries", methods=['GET', 'POST'])
+def rebuild_issue_summaries():
+    """
+    Rewrites the IssueSummary of every issue, 100 issues per task.  Run this after upgrading from
+    an earlier version of spark-prs or after changing the summary format or the list of committers.
+    """
+    cursor = Cursor(urlsafe=request.args.get('cursor'))
+    (keys, next_cursor, more) = Issue.query().fetch_page(100, start_cursor=cursor,
+                                                         keys_only=True)
+    for key in keys:
+        # Query results can be stale, so rebuild each summary from the issue within a transaction,
+        # so that a summary that a sync task just wrote isn't overwritten:
+        update_issue(int(key.id()), lambda pr: None)
+    if more and next_cursor:
+        taskqueue.add(url=url_for(".rebuild_issue_summaries", cursor=next_cursor.urlsafe()))
+    return "Rebuilt summaries for %i issues" % len(keys)
+
+
+@tasks.route("/slim-issues", methods=['GET', 'POST'])
+def slim_issues():
+    """
+    Prunes the stored GitHub JSON of every issue down to the fields that we use, rewriting
+    pr_json in compressed form and moving the comments, review comments and files into IssueData
+    children.  Run this once after upgrading from a version of spark-prs that stored the full
+    GitHub payloads in the issues.  Each task handles one batch and chains the next one with a
+    cursor, so a failed task is retried from where it left off.
+    """
+    cursor = Cursor(urlsafe=request.args.get('cursor'))
+    # Unpruned issues can approach the 1 MB entity size limit, so keep the batches small:
+    (keys, next_cursor, more) = Issue.query().fetch_page(20, start_cursor=cursor, keys_only=True)
+    for key in keys:
+        # Each issue is rewritten transactionally, so that concurrent sync tasks' updates aren't
+        # overwritten:
+        update_issue(int(key.id()), slim_issue)
+    if more and next_cursor:
+        taskqueue.add(url=url_for(".slim_issues", cursor=next_cursor.urlsafe()))
+    return "Slimmed %i issues" % len(keys)
+
+
+def slim_issue(issue):
+    issue.pr_json = prune_json(issue.pr_json, PR_SCHEMA)
+    issue.comments_json = prune_json(issue.comments_json, COMMENT_SCHEMA)
+    issue.pr_comments_json = prune_json(issue.pr_comments_json, REVIEW_COMMENT_SCHEMA)
+    issue.files_json = prune_json(issue.files_json, FILE_SCHEMA)
+    issue.last_jenkins_comment = prune_json(issue.last_jenkins_comment, COMMENT_SCHEMA)
+
+
+@tasks.route("/render-pr-list/<string:name>", methods=['GET', 'POST'])
+def render_pr_list(name):
+    if name not in PR_LIST_QUERIES:
+        return abort(404)
+    rendered = render_pr_list_json(name)
+    return "Rendered %s PR list (%i bytes gzipped)" % (name, len(rendered['gzip_body']))
+
+
 @tasks.route("/update-jira-issues")
 def update_jira_issues():
-    feed_url = "%s/activity?maxResults=20&streams=key+IS+%s&providers=issues" % \
-               (app.config['JIRA_API_BASE'], app.config['JIRA_PROJECT'])
-    feed = feedparser.parse(feed_url)
-    # To avoid double-processing of RSS feed entries, only process entries that are newer than
-    # the watermark set during the last refresh:
-    last_watermark = KVS.get("jira_sync_watermark")
-    if last_watermark is not None:
-        new_entries = [i for i in feed.entries if i.published_parsed > last_watermark]
-    else:
-        new_entries = feed.entries
-    if not new_entries:
-        return "No new entries to update since last watermark " + str(last_watermark)
-    issue_ids = set(i.link.split('/')[-1] for i in new_entries)
-    for issue in issue_ids:
-        taskqueue.add(url="/tasks/update-jira-issue/" + issue, queue_name='jira-issues')
-    KVS.put('jira_sync_watermark', new_entries[0].published_parsed)
-    return "Queued JIRA issues for update: " + str(issue_ids)
+    """
+    Syncs every JIRA issue that was updated since the last sync, using JIRA's search API to fetch
+    them in pages of JIRA_SEARCH_PAGE_SIZE issues, oldest update first, with only the fields that
+    we use.  Each page is stored in one batch.
+
+    JQL dates only have minute precision, so the watermark is the minute in which the last synced
+    issue was updated, plus the number of issues from that minute that the current sync has
+    already stored (only needed when a whole page was updated in the same minute).  It's saved
+    after every page, so an interrupted sync resumes where it left off.  Every sync starts by
+    re-fetching the issues from the watermark's minute, so none of them can be missed.
+    """
+    watermark = KVS.get("jira_search_watermark")
+    num_synced = 0
+    while True:
+        if watermark is None:
+            # The first sync only looks back one day; use /update-jira-issues-for-all-open-prs
+            # to load older issues.
+            (updated_since, start_at) = ("-1d", 0)
+        else:
+            (updated_since, start_at) = ('"%s"' % watermark['minute'], watermark['skip'])
+        jql = "project = %s AND updated >= %s ORDER BY updated ASC, key ASC" % \
+            (app.config['JIRA_PROJECT'], updated_since)
+        issues = search_issues(jql, JIRAIssue.FIELDS + ['updated'], start_at=start_at,
+                               max_results=JIRA_SEARCH_PAGE_SIZE)
+        if issues:
+            JIRAIssue.put_from_search(issues)
+            num_synced += len(issues)
+            watermark = advance_jira_watermark(watermark, issues)
+        if len(issues) < JIRA_SEARCH_PAGE_SIZE:
+            break
+        KVS.put("jira_search_watermark", watermark)
+    if watermark is not None:
+        KVS.put("jira_search_watermark", dict(watermark, skip=0))
+    return "Synced %i JIRA issues; the watermark is now %s" % (num_synced, watermark)
 
 
 @tasks.route("/update-jira-issues-for-all-open-prs")
@@ -0,0 +1,79 @@
+import hashlib
+import hmac
+import json
+import logging
+import time
+
+from flask import Blueprint, request, abort, url_for
+from google.appengine.api import taskqueue
+
+from sparkprs import app
+from sparkprs.task_queues import enqueue_tasks, task_name
+
+
+webhooks = Blueprint('webhooks', __name__)
+
+
+# Events for the same pull request that arrive within this many seconds of each other are
+# coalesced into a single sync task:
+COALESCING_WINDOW = 10
+
+
+def verify_signature(payload, signature):
+    """
+    Checks a webhook delivery's X-Hub-Signature-256 header against GITHUB_WEBHOOK_SECRET.
+    """
+    secret = app.config.get('GITHUB_WEBHOOK_SECRET')
+    if not secret or not signature or not signature.startswith('sha256='):
+        return False
+    expected = hmac.new(str(secret), payload, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, str(signature[len('sha256='):]))
+
+
+def enqueue_coalesced(endpoint, queue_name='fresh-prs', **values):
+    """
+    Enqueues a task for `endpoint`, unless an identical task was already enqueued during the
+    current coalescing window.  Tasks are named after their window and delayed until it ends,
+    so a burst of events results in a single task that sees the effects of all of them.
+    """
+    now = time.time()
+    window = int(now // COALESCING_WINDOW)
+    name = task_name(endpoint, *([values[k] for k in sorted(values)] + [window]))
+    task = taskqueue.Task(url=url_for(endpoint, **values), name=name,
+                          countdown=(window + 1) * COALESCING_WINDOW - now)
+    if not enqueue_tasks([task], queue_name=queue_name):
+        logging.debug("Coalesced task %s into an already-enqueued task" % name)
+
+
+@webhooks.route('/github', methods=['POST'])
+def github_webhook():
+    """
+    Receives GitHub webhook deliveries and enqueues the sync work that each event implies.
+    Configure the webhook to send pull_request, issue_comment, pull_request_review_comment and
+    push events as JSON, signed with GITHUB_WEBHOOK_SECRET.
+    """
+    payload = request.get_data()
+    if not verify_signature(payload, request.headers.get('X-Hub-Signature-256')):
+        return abort(403)
+    event = request.headers.get('X-GitHub-Event')
+    data = json.loads(payload)
+    if event == 'ping':
+        return "pong"
+    if (data.get('repository') or {}).get('full_name') != app.config['GITHUB_PROJECT']:
+        return "Ignoring event for another repository"
+    # In GraphQL mode, update_pr refreshes the comments, review comments and files as well:
+    graphql_mode = app.config.get('GITHUB_SYNC_MODE', 'rest') == 'graphql'
+    if event == 'pull_request':
+        enqueue_coalesced('tasks.update_pr', pr_number=data['pull_request']['number'])
+    elif event == 'issue_comment' and 'pull_request' in data['issue']:
+        enqueue_coalesced('tasks.update_pr' if graphql_mode else 'tasks.update_pr_comments',
+                          pr_number=data['issue']['number'])
+    elif event == 'pull_request_review_comment':
+        enqueue_coalesced(
+            'tasks.update_pr' if graphql_mode else 'tasks.update_pr_review_comments',
+            pr_number=data['pull_request']['number'])
+    elif event == 'push' and not data.get('deleted'):
+        enqueue_coalesced('tasks.update_prs_for_commit', sha=data['after'])
+    else:
+        return "Ignoring %s event" % event
+    return "Enqueued sync tasks for %s event" % event
@@ -1,13 +1,24 @@
-from google.appengine.api import urlfetch
+from collections import deque
+from google.appengine.api import memcache, urlfetch
 from link_header import parse as parse_link_header
 from urllib2 import HTTPError
+import hashlib
+import itertools
 import logging
 import json
+import time
+import urllib
+import urlparse
+import zlib
 
 from sparkprs import app
 
 BASE_URL = 'https://api.github.com/'
 BASE_AUTH_URL = 'https://github.com/login/oauth/'
+# Maximum number of concurrent requests used when fetching the pages of a paginated endpoint:
+MAX_CONCURRENT_REQUESTS = 10
+# Number of items requested per page from paginated endpoints (GitHub's maximum):
+PAGE_SIZE = 100
 
 
 def get_issues_base():
@@ -22,15 +33,40 @@ def github_request(resource, oauth_token=None, etag=None):
     return raw_github_request(BASE_URL + resource, oauth_token, etag)
 
 
-def raw_github_request(url, oauth_token=None, etag=None, method="GET"):
+class GitHubRateLimitExceeded(Exception):
+    """
+    Raised when GitHub rejects a request because of rate limiting, or instead of issuing a
+    request while the rate limit for its OAuth token is known to be exhausted.
+    """
+
+    def __init__(self, retry_after):
+        Exception.__init__(self, "GitHub rate limit exceeded; retry in %i seconds" % retry_after)
+        self.retry_after = retry_after
+
+
+def raw_github_request(url, oauth_token=None, etag=None, method="GET", payload=None,
+                       rate_limit_resource='core'):
+    _check_rate_limit(oauth_token, rate_limit_resource)
+    headers = _get_request_headers(oauth_token, etag)
+    logging.info("Requesting %s from GitHub with headers %s" % (url, headers))
+    response = urlfetch.fetch(url, payload=payload, headers=headers, method=method)
+    return _handle_response(url, response, method, oauth_token)
+
+
+def _get_request_headers(oauth_token=None, etag=None):
     headers = {}
     if etag is not None:
         headers['If-None-Match'] = etag
     if oauth_token is not None:
         headers["Authorization"] = "token %s" % oauth_token
-    logging.info("Requesting %s from GitHub with headers %s" % (url, headers))
-    response = urlfetch.fetch(url, headers=headers, method=method)
-    if response.status_code == 304:
+    return headers
+
+
+def _handle_response(url, response, method="GET", oauth_token=None):
+    backoff_time = _record_rate_limit(oauth_token, response)
+    if backoff_time is not None:
+        raise GitHubRateLimitExceeded(backoff_time)
+    elif response.status_code == 304:
         return None
     elif method.lower() == "delete":
         return response
@@ -42,32 +78,286 @@ def raw_github_request(url, oauth_token=None, etag=None, method="GET"):
         raise Exception("Unexpected status code: %i\n%s" % (response.status_code, response.content))
 
 
-def paginated_github_request(url, oauth_token=None, etag=None):
+def _get_rate_limit_keys(oauth_token, resource='core'):
+    # Each OAuth token has its own rate limit, so track them separately (without storing the
+    # tokens themselves in memcache).  The REST ('core') and GraphQL APIs have separate budgets,
+    # while the secondary rate limits' backoff applies to both:
+    token_hash = hashlib.sha1(oauth_token or "").hexdigest()
+    return ("github-rate-limit-%s-%s" % (resource, token_hash),
+            "github-rate-limit-backoff-" + token_hash)
+
+
+def _record_rate_limit(oauth_token, response):
     """
-    Retrieve and decode JSON from GitHub endpoints that use pagination.
-    Automatically follows 'next' links.
+    Records the rate limit budget reported in a response's headers.  If the response indicates
+    that the request was rate-limited, returns the number of seconds that GitHub asked us to
+    wait before retrying.
+    """
+    resource = response.headers.get('X-RateLimit-Resource', 'core')
+    (budget_key, backoff_key) = _get_rate_limit_keys(oauth_token, resource)
+    now = int(time.time())
+    remaining = response.headers.get('X-RateLimit-Remaining')
+    reset = response.headers.get('X-RateLimit-Reset')
+    if remaining is not None and reset is not None:
+        memcache.set(budget_key, {'remaining': int(remaining), 'reset': int(reset)},
+                     time=max(1, int(reset) - now))
+    if response.status_code not in (403, 429):
+        return None
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is not None and retry_after.isdigit():
+        # GitHub's secondary rate limits ask clients to wait for a fixed amount of time:
+        backoff_time = int(retry_after)
+        memcache.set(backoff_key, now + backoff_time, time=max(1, backoff_time))
+        return backoff_time
+    elif remaining == '0':
+        return max(0, int(reset) - now)
+    else:
+        return None
 
-    :return: (Decoded JSON, ETag) pair
+
+def get_rate_limit_wait_time(oauth_token=None, reserve=0, resource='core'):
+    """
+    Returns the number of seconds to wait before issuing GitHub requests using `oauth_token` so
+    that more than `reserve` requests remain in its rate limit budget for `resource` ('core' for
+    the REST API, or 'graphql'), or 0 if it's fine to issue requests now.
+
+    The budget is tracked in memcache from the rate limit headers of GitHub's responses, so it
+    is shared by every instance.
+    """
+    (budget_key, backoff_key) = _get_rate_limit_keys(oauth_token, resource)
+    state = memcache.get_multi([budget_key, backoff_key])
+    now = int(time.time())
+    wait_time = state.get(backoff_key, now) - now
+    budget = state.get(budget_key)
+    if budget is not None and budget['remaining'] <= reserve:
+        wait_time = max(wait_time, budget['reset'] - now)
+    return max(0, wait_time)
+
+
+def _check_rate_limit(oauth_token, resource='core'):
+    wait_time = get_rate_limit_wait_time(oauth_token, resource=resource)
+    if wait_time > 0:
+        raise GitHubRateLimitExceeded(wait_time)
+
+
+def _get_links(response):
+    link_header = parse_link_header(response.headers.get('Link', ''))
+    return dict((link.rel, link.href) for link in link_header.links)
+
+
+def _get_remaining_page_urls(response):
+    """
+    Returns the URLs of the pages after this response's page, or None if its Link header doesn't
+    reveal the last page.
     """
-    # Grab the first page
-    initial_response = raw_github_request(url, oauth_token, etag)
-    if initial_response is None:
+    links = _get_links(response)
+    if 'next' not in links or 'last' not in links:
+        return None
+    (next_page, last_page) = [_get_page_number(links[rel]) for rel in ('next', 'last')]
+    if next_page is None or last_page is None:
         return None
-    result = json.loads(initial_response.content)
-    etag = initial_response.headers["ETag"]
+    return [_set_query_param(links['last'], 'page', page)
+            for page in xrange(next_page, last_page + 1)]
+
+
+def _get_page_number(url):
+    query = dict(urlparse.parse_qsl(urlparse.urlsplit(url).query))
+    if query.get('page', '1').isdigit():
+        return int(query.get('page', '1'))
+
+
+def _set_query_param(url, name, value):
+    (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+    query = [(k, v) for (k, v) in urlparse.parse_qsl(query) if k != name] + [(name, value)]
+    return urlparse.urlunsplit((scheme, netloc, path, urllib.urlencode(query), fragment))
+
+
+class GitHubResponse(object):
+    """
+    A successful response from GitHub.  If GitHub reported that the resource hasn't changed since
+    it was last fetched, then the response is served from the response cache and `not_modified`
+    is True.
+    """
+
+    def __init__(self, content, headers, not_modified=False):
+        self.content = content
+        self.headers = headers
+        self.not_modified = not_modified
+        self._json = None
+
+    def json(self):
+        if self._json is None:
+            self._json = json.loads(self.content)
+        return self._json
+
 
-    # Continue following 'next' links, appending the decoded responses to 'result'
+def _get_response_cache_key(url, oauth_token):
+    return "github-response-" + hashlib.sha1("%s %s" % (oauth_token or "", url)).hexdigest()
+
+
+def _start_cached_request(url, oauth_token, cached):
+    """
+    Starts an async GET of `url`, made conditional on the ETag of its `cached` response (if any).
+    """
+    _check_rate_limit(oauth_token)
+    headers = _get_request_headers(oauth_token, cached and cached['etag'])
+    logging.info("Requesting %s from GitHub with headers %s" % (url, headers))
+    rpc = urlfetch.create_rpc()
+    urlfetch.make_fetch_call(rpc, url, headers=headers)
+    return rpc
 
-    def get_next_url(resp):
-        link_header = parse_link_header(resp.headers.get('Link', ''))
-        for link in link_header.links:
-            if link.rel == 'next':
-                return link.href
 
-    next_url = get_next_url(initial_response)
-    while next_url:
-        response = raw_github_request(next_url, oauth_token)
-        result.extend(json.loads(response.content))
-        next_url = get_next_url(response)
+def _finish_cached_request(url, oauth_token, rpc, cached):
+    response = _handle_response(url, rpc.get_result(), oauth_token=oauth_token)
+    if response is None:
+        # Prefer the Link header from the 304 response, in case the number of pages has changed:
+        link = rpc.get_result().headers.get('Link', cached['link'])
+        return GitHubResponse(zlib.decompress(cached['content']),
+                              {'ETag': cached['etag'], 'Link': link}, not_modified=True)
+    headers = {'ETag': response.headers.get('ETag'), 'Link': response.headers.get('Link', '')}
+    if headers['ETag']:
+        try:
+            memcache.set(_get_response_cache_key(url, oauth_token), {
+                'etag': headers['ETag'],
+                'link': headers['Link'],
+                'content': zlib.compress(response.content),
+            })
+        except ValueError:
+            logging.warning("Response from %s is too large to cache" % url)
+    return GitHubResponse(response.content, headers)
 
-    return result, etag
+
+def cached_github_request(url, oauth_token=None):
+    """
+    Issues a GET request to GitHub, returning a GitHubResponse.
+
+    Responses are cached in memcache along with their ETags and revalidated using conditional
+    requests; GitHub doesn't count requests that return 304 Not Modified against the rate limit.
+    """
+    cached = memcache.get(_get_response_cache_key(url, oauth_token))
+    rpc = _start_cached_request(url, oauth_token, cached)
+    return _finish_cached_request(url, oauth_token, rpc, cached)
+
+
+def iter_github_pages(url, oauth_token=None, max_concurrent=MAX_CONCURRENT_REQUESTS,
+                      ramp_up=False):
+    """
+    Yields a GitHubResponse for every page of a paginated GitHub endpoint, in order.  Each page
+    is cached and revalidated individually, as in `cached_github_request`.
+
+    Once the first page's Link header reveals the last page, the remaining pages are fetched
+    concurrently using async urlfetch RPCs, with at most `max_concurrent` requests in flight.
+    If `ramp_up` is True then the number of requests in flight starts at one and doubles after
+    every page, which limits the number of wasted requests when the caller may stop consuming
+    pages early.
+    """
+    url = _set_query_param(url, 'per_page', PAGE_SIZE)
+    initial_response = cached_github_request(url, oauth_token)
+    yield initial_response
+
+    page_urls = _get_remaining_page_urls(initial_response)
+    if page_urls is None:
+        # Fall back to following 'next' links one at a time:
+        (last_url, last_response) = (url, initial_response)
+        next_url = _get_links(initial_response).get('next')
+        while next_url:
+            (last_url, last_response) = (next_url, cached_github_request(next_url, oauth_token))
+            yield last_response
+            next_url = _get_links(last_response).get('next')
+    else:
+        cached_pages = memcache.get_multi(
+            [_get_response_cache_key(page_url, oauth_token) for page_url in page_urls])
+        page_urls_iter = iter(page_urls)
+        in_flight = deque()  # (url, rpc, cached response) tuples, in page order
+        window = 1 if ramp_up else max_concurrent
+        while True:
+            for page_url in itertools.islice(page_urls_iter, max(0, window - len(in_flight))):
+                cached = cached_pages.get(_get_response_cache_key(page_url, oauth_token))
+                rpc = _start_cached_request(page_url, oauth_token, cached)
+                in_flight.append((page_url, rpc, cached))
+            if not in_flight:
+                break
+            (last_url, rpc, cached) = in_flight.popleft()
+            last_response = _finish_cached_request(last_url, oauth_token, rpc, cached)
+            yield last_response
+            window = min(window * 2, max_concurrent)
+
+    # A page's ETag only covers its body, so a cached Link header may not know about pages that
+    # were added after the last page filled up.  Probe for them explicitly:
+    while len(last_response.json()) >= PAGE_SIZE:
+        last_url = _set_query_param(last_url, 'page', _get_page_number(last_url) + 1)
+        last_response = cached_github_request(last_url, oauth_token)
+        if not last_response.json():
+            break
+        yield last_response
+
+
+def delete_github_resources(urls, oauth_token=None, max_concurrent=MAX_CONCURRENT_REQUESTS):
+    """
+    Deletes GitHub resources using concurrent async DELETE requests, with at most
+    `max_concurrent` requests in flight.  Failures are logged rather than raised, and no new
+    requests are started once the rate limit is exhausted, so that callers can retry just the
+    resources that weren't deleted.
+
+    :return: the set of URLs that were deleted (including ones that had already been deleted),
+             and the set of URLs whose deletion failed transiently (with a server error, the rate
+             limit or a fetch error) and so is worth retrying.  Other failures, such as 403s for
+             tokens that aren't allowed to delete, are in neither set.
+    """
+    deleted = set()
+    failed = set()
+    urls_iter = iter(urls)
+    in_flight = deque()  # (url, rpc) pairs
+    while True:
+        try:
+            for url in itertools.islice(urls_iter, max(0, max_concurrent - len(in_flight))):
+                _check_rate_limit(oauth_token)
+                logging.info("Deleting %s from GitHub" % url)
+                rpc = urlfetch.create_rpc()
+                urlfetch.make_fetch_call(rpc, url, headers=_get_request_headers(oauth_token),
+                                         method="DELETE")
+                in_flight.append((url, rpc))
+        except GitHubRateLimitExceeded as e:
+            logging.warning("Not deleting any more resources: %s" % e)
+            failed.add(url)
+            failed.update(urls_iter)
+        if not in_flight:
+            break
+        (url, rpc) = in_flight.popleft()
+        try:
+            response = _handle_response(url, rpc.get_result(), "DELETE", oauth_token)
+            if response.status_code in (204, 404):
+                deleted.add(url)
+            else:
+                logging.warning("Failed to delete %s: status code %i" %
+                                (url, response.status_code))
+                if response.status_code >= 500:
+                    failed.add(url)
+        except Exception:
+            logging.exception("Failed to delete %s" % url)
+            failed.add(url)
+    return (deleted, failed)
+
+
+def paginated_github_request(url, oauth_token=None, etag=None):
+    """
+    Retrieve and decode JSON from GitHub endpoints that use pagination.
+    Automatically fetches every page, concurrently if possible.
+
+    The returned ETag identifies the combined contents of every page. Pass the ETag from a
+    previous call as `etag` to get None back if nothing has changed since then.
+
+    :return: (Decoded JSON, ETag) pair, or None
+    """
+    responses = list(iter_github_pages(url, oauth_token))
+    page_etags = [response.headers['ETag'] or '' for response in responses]
+    if len(page_etags) == 1:
+        combined_etag = page_etags[0]
+    else:
+        combined_etag = hashlib.sha1('\n'.join(page_etags)).hexdigest()
+    if etag is not None and etag == combined_etag and all(r.not_modified for r in responses):
+        return None
+    result = []
+    for response in responses:
+        result.extend(response.json())
+    return result, combined_etag
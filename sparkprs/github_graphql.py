@@ -0,0 +1,127 @@
+"""
+Fetches a pull request's metadata, comments, review comments and files from GitHub's GraphQL API
+in a single round-trip (plus continuation queries for long lists), converting the results into
+the same shapes as the REST API's JSON so that they can populate the same `Issue` fields.
+
+The endpoint is configurable through GITHUB_GRAPHQL_URL, so this can be pointed at a local fake
+server that serves recorded responses.  The conversions and the handling of continuation queries
+are pure functions in sparkprs.utils, which are tested against recorded responses there.
+"""
+import json
+import logging
+
+from sparkprs import app
+from sparkprs.github_api import BASE_URL, raw_github_request, get_issues_base, get_pulls_base, \
+    get_rate_limit_wait_time, GitHubRateLimitExceeded
+from sparkprs.utils import fetch_graphql_connections, graphql_pr_json, graphql_comment_json, \
+    graphql_file_json
+
+
+PULL_REQUEST_QUERY = """
+query($owner: String!, $name: String!, $number: Int!,
+      $withComments: Boolean!, $commentsCursor: String,
+      $withReviewThreads: Boolean!, $reviewThreadsCursor: String,
+      $withFiles: Boolean!, $filesCursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      number
+      title
+      state
+      mergeable
+      additions
+      deletions
+      createdAt
+      updatedAt
+      url
+      headRefOid
+      baseRefName
+      author { login avatarUrl }
+      comments(first: 100, after: $commentsCursor) @include(if: $withComments) {
+        pageInfo { hasNextPage endCursor }
+        nodes { databaseId url body createdAt updatedAt author { login avatarUrl } }
+      }
+      reviewThreads(first: 50, after: $reviewThreadsCursor) @include(if: $withReviewThreads) {
+        pageInfo { hasNextPage endCursor }
+        nodes {
+          comments(first: 100) {
+            pageInfo { hasNextPage }
+            nodes {
+              databaseId url body createdAt updatedAt author { login avatarUrl } diffHunk
+            }
+          }
+        }
+      }
+      files(first: 100, after: $filesCursor) @include(if: $withFiles) {
+        pageInfo { hasNextPage endCursor }
+        nodes { path additions deletions }
+      }
+    }
+  }
+}
+"""
+
+# Maps the names of the pull request's paginated connections to the query variables that
+# control them:
+CONNECTIONS = [
+    ('comments', 'withComments', 'commentsCursor'),
+    ('reviewThreads', 'withReviewThreads', 'reviewThreadsCursor'),
+    ('files', 'withFiles', 'filesCursor'),
+]
+
+
+def get_graphql_url():
+    return app.config.get('GITHUB_GRAPHQL_URL', BASE_URL + 'graphql')
+
+
+def graphql_request(query, variables, oauth_token=None):
+    payload = json.dumps({'query': query, 'variables': variables})
+    response = raw_github_request(get_graphql_url(), oauth_token=oauth_token, method="POST",
+                                  payload=payload, rate_limit_resource='graphql')
+    return json.loads(response.content)
+
+
+def fetch_pull_request(number, oauth_token=None):
+    """
+    Fetches a pull request and all of its comments, review comments and files.
+
+    :return: a dict with `pr_json`, `comments_json`, `pr_comments_json` and `files_json` keys,
+             in the REST API's formats, or None if the pull request doesn't exist.
+    """
+    (owner, name) = app.config['GITHUB_PROJECT'].split('/')
+
+    def query_pull_request(variables):
+        result = graphql_request(PULL_REQUEST_QUERY, variables, oauth_token=oauth_token)
+        page = ((result.get('data') or {}).get('repository') or {}).get('pullRequest')
+        if page is None:
+            error_types = set(e.get('type') for e in result.get('errors', []))
+            if 'NOT_FOUND' in error_types:
+                return None
+            elif 'RATE_LIMITED' in error_types:
+                # GraphQL reports rate limiting with a 200 response, so wait for the budget
+                # that the response's headers reported to reset:
+                raise GitHubRateLimitExceeded(
+                    get_rate_limit_wait_time(oauth_token, resource='graphql') or 60)
+            raise Exception("Unexpected GraphQL response for PR %i: %s" % (number, result))
+        return page
+    fetched = fetch_graphql_connections(
+        query_pull_request, {'owner': owner, 'name': name, 'number': number}, CONNECTIONS)
+    if fetched is None:
+        return None
+    (pull_request, nodes) = fetched
+
+    review_comments = []
+    for thread in nodes['reviewThreads']:
+        if thread['comments']['pageInfo']['hasNextPage']:
+            logging.warning("Review thread on PR %i has more than 100 comments; truncating" %
+                            number)
+        review_comments.extend(
+            graphql_comment_json(c, get_pulls_base() + '/comments/%i' % c['databaseId'])
+            for c in thread['comments']['nodes'])
+    return {
+        'pr_json': graphql_pr_json(pull_request),
+        'comments_json': [
+            graphql_comment_json(c, get_issues_base() + '/comments/%i' % c['databaseId'])
+            for c in nodes['comments']],
+        'pr_comments_json': sorted(review_comments, key=lambda c: c['created_at']),
+        'files_json': [graphql_file_json(f) for f in nodes['files']],
+    }
@@ -1,30 +1,114 @@
 """
 Functions for integrating with JIRA.
 """
+from contextlib import contextmanager
+import json
 import logging
+import Queue
+import urllib
 
 from google.appengine.api import urlfetch
+import google.appengine.ext.ndb as ndb
 import jira.client
+from jira.exceptions import JIRAError
 
 from sparkprs import app
+from sparkprs.models import JIRALinkRecord
 
 
-def get_jira_client():
+# The most idle JIRA clients to keep for reuse by this instance's request threads:
+MAX_IDLE_CLIENTS = 4
+
+# Creating a client costs a server info request and a new session, so clients are reused.  Each
+# one is only used by one thread at a time, and keeps its session's connections alive:
+_idle_clients = Queue.LifoQueue(maxsize=MAX_IDLE_CLIENTS)
+
+
+@contextmanager
+def jira_client():
+    """
+    Lends the calling thread an authenticated JIRA client from this instance's pool, creating a
+    new one if none are idle, and returns it to the pool afterwards.
+    """
     # Bump up the default fetch deadline.
     # This setting is thread-specific, which is why we set it here.
     urlfetch.set_default_fetch_deadline(60)
-    return jira.client.JIRA({'server': app.config['JIRA_API_BASE']},
-                            basic_auth=(app.config['JIRA_USERNAME'],
-                                        app.config['JIRA_PASSWORD']))
+    try:
+        client = _idle_clients.get_nowait()
+    except Queue.Empty:
+        client = jira.client.JIRA({'server': app.config['JIRA_API_BASE']},
+                                  basic_auth=(app.config['JIRA_USERNAME'],
+                                              app.config['JIRA_PASSWORD']))
+    try:
+        yield client
+    finally:
+        try:
+            _idle_clients.put_nowait(client)
+        except Queue.Full:
+            pass
+
+
+def is_permanent_error(e):
+    """
+    Returns True if `e` is an error that retrying the same JIRA request won't fix: JIRA's 4xx
+    responses for issues that don't exist or that we aren't allowed to modify (but not 429s, which
+    are rate limits).
+    """
+    return isinstance(e, JIRAError) and e.status_code is not None and \
+        400 <= e.status_code < 500 and e.status_code != 429
+
+
+def _is_done(issue, field, pr_url):
+    record = JIRALinkRecord.get_by_id(issue)
+    return record is not None and pr_url in getattr(record, field)
 
 
-def start_issue_progress(issue):
+@ndb.transactional
+def _record_done(issue, field, pr_url):
+    record = JIRALinkRecord.get_by_id(issue) or JIRALinkRecord(id=issue)
+    urls = getattr(record, field)
+    if pr_url not in urls:
+        urls.append(pr_url)
+        record.put()
+
+
+def search_issues(jql, fields, start_at=0, max_results=100):
     """
-    Given an issue key, e.g. SPARK-6481, mark the issue "In Progress".
+    Returns one page of the issues that match a JQL query, with only the given fields, using
+    JIRA's search API.  Requests are anonymous, like the JIRAIssue updates, so JQL dates are
+    interpreted in the JIRA server's default time zone, which is also the one that the
+    returned dates are in.
+    """
+    params = urllib.urlencode({
+        'jql': jql,
+        'fields': ','.join(fields),
+        'startAt': start_at,
+        'maxResults': max_results,
+    })
+    url = "%s/rest/api/2/search?%s" % (app.config['JIRA_API_BASE'], params)
+    response = urlfetch.fetch(url, deadline=60)
+    if response.status_code != 200:
+        raise Exception("JIRA search for '%s' failed with HTTP %i: %s" %
+                        (jql, response.status_code, response.content))
+    return json.loads(response.content)['issues']
+
 
-    This will only happen if the issue's initial state is "Open" or "Reopened".
+def start_issue_progress(issue, pr):
     """
-    jira_client = get_jira_client()
+    Given an issue key, e.g. SPARK-6481, and a pull request for it, mark the issue "In Progress".
+
+    This will only happen if the issue's initial state is "Open" or "Reopened", and only the
+    first time that it's called for each pull request.
+    """
+    url = pr.pr_json['html_url']
+    if _is_done(issue, 'progress_pr_urls', url):
+        return
+    with jira_client() as client:
+        _start_issue_progress(client, issue)
+    _record_done(issue, 'progress_pr_urls', url)
+
+
+def _start_issue_progress(jira_client, issue):
     issue_info = jira_client.issue(issue)
     status = issue_info.fields.status.name
     assignee = issue_info.fields.assignee.name if issue_info.fields.assignee else None
@@ -57,8 +141,18 @@ def link_issue_to_pr(issue, pr):
     Create a link in JIRA to a pull request and add a comment linking to the PR.
 
     This method is idempotent; the links will only be created if they do not already exist.
+    Links that already exist are recorded in the datastore, so JIRA is only asked about each
+    link once.
     """
-    jira_client = get_jira_client()
+    url = pr.pr_json['html_url']
+    if _is_done(issue, 'linked_pr_urls', url):
+        return
+    with jira_client() as client:
+        _link_issue_to_pr(client, issue, pr)
+    _record_done(issue, 'linked_pr_urls', url)
+
+
+def _link_issue_to_pr(jira_client, issue, pr):
     url = pr.pr_json['html_url']
     title = "[Github] Pull Request #%s (%s)" % (pr.number, pr.user)
 
@@ -1,11 +1,13 @@
 import google.appengine.ext.ndb as ndb
 from google.appengine.api import urlfetch
 from collections import defaultdict
+import hashlib
 import json
 import logging
-import re
+from more_itertools import chunked
 from sparkprs import app
-from sparkprs.utils import parse_pr_title, is_jenkins_command, compute_last_jenkins_outcome
+from sparkprs.utils import parse_pr_title, compute_last_jenkins_outcome, ComponentClassifier, \
+    analyze_github_comment
 
 
 class KVS(ndb.Model):
@@ -35,6 +37,22 @@ class User(ndb.Model):
     github_user_json = ndb.JsonProperty()
     roles = ndb.StringProperty(repeated=True)
 
+    @classmethod
+    def get_by_login(cls, github_login):
+        """
+        Returns the user with the given GitHub login, or None.  Users are keyed by their logins,
+        so this is a key lookup, which ndb serves from memcache until the user is next written.
+        Users that were stored with generated keys are re-keyed when they're first looked up.
+        """
+        user = User.get_by_id(github_login)
+        if user is None:
+            legacy_user = User.query(User.github_login == github_login).get()
+            if legacy_user is not None:
+                user = User(id=github_login, **legacy_user.to_dict())
+                user.put()
+                legacy_user.key.delete()
+        return user
+
     def has_capability(self, capability):
         if "admin" in self.roles:
             return True
@@ -44,6 +62,22 @@ class User(ndb.Model):
             return False
 
 
+def _issue_data_property(name, doc):
+    """
+    Returns a property for the data in one of an `Issue`'s `IssueData` children, which is loaded
+    on first access.  Assigning to the property marks the child to be written by
+    `Issue.put_with_summary`.
+    """
+    def get_data(self):
+        self.load_data(name)
+        return self._issue_data[name]
+
+    def set_data(self, value):
+        self._issue_data[name] = value
+        self._modified_data.add(name)
+    return property(get_data, set_data, doc=doc)
+
+
 class Issue(ndb.Model):
     number = ndb.IntegerProperty(required=True)
     updated_at = ndb.DateTimeProperty()
@@ -51,10 +85,13 @@ class Issue(ndb.Model):
     state = ndb.StringProperty()
     title = ndb.StringProperty()
     # Raw JSON data
-    pr_json = ndb.JsonProperty()
-    comments_json = ndb.JsonProperty(compressed=True)
-    pr_comments_json = ndb.JsonProperty(compressed=True)
-    files_json = ndb.JsonProperty(compressed=True)
+    pr_json = ndb.JsonProperty(compressed=True)
+    # The comments, review comments and files are stored in IssueData children (see below).  These
+    # properties hold the data of issues that were written before it was split out, until the
+    # issues are next updated:
+    legacy_comments_json = ndb.JsonProperty('comments_json', compressed=True)
+    legacy_pr_comments_json = ndb.JsonProperty('pr_comments_json', compressed=True)
+    legacy_files_json = ndb.JsonProperty('files_json', compressed=True)
     # ETags for limiting our GitHub requests
     etag = ndb.StringProperty()
     comments_etag = ndb.StringProperty()
@@ -62,13 +99,13 @@ class Issue(ndb.Model):
     files_etag = ndb.StringProperty()
     # Cached properties, while we migrate away from on-the-fly computed ones:
     cached_commenters = ndb.PickleProperty()
+    # High-water mark and digest of the comments that cached_commenters was computed from:
+    commenters_state = ndb.JsonProperty()
     cached_last_jenkins_outcome = ndb.StringProperty()
     last_jenkins_comment = ndb.JsonProperty()
-
-    ASKED_TO_CLOSE_REGEX = re.compile(r"""
-        (mind\s+closing\s+(this|it))|
-        (close\s+this\s+(issue|pr))
-    """, re.I | re.X)
+    cached_components = ndb.StringProperty(repeated=True, indexed=False)
+    # Hash of the rules, title and files_etag that cached_components was computed from:
+    components_cache_key = ndb.StringProperty(indexed=False)
 
     _components = [
         # (name, pr_title_regex, filename_regex)
@@ -88,6 +125,54 @@ class Issue(ndb.Model):
         ("Streaming", "stream|flume|kafka|twitter|zeromq", "streaming"),
         ("R", "SparkR", "(^r/)|src/main/r/|api/r/"),
     ]
+    _component_classifier = ComponentClassifier(_components)
+    # Part of the components' cache key, so that changing the rules invalidates cached components:
+    _components_digest = hashlib.sha1(repr(_components)).hexdigest()
+
+    # The names of the IssueData children, which are also the names of their properties:
+    DATA_NAMES = ('comments_json', 'pr_comments_json', 'files_json')
+    comments_json = _issue_data_property('comments_json', "The PR's issue comments.")
+    pr_comments_json = _issue_data_property('pr_comments_json', "The PR's review comments.")
+    files_json = _issue_data_property('files_json', "The files that the PR modifies.")
+
+    @property
+    def _issue_data(self):
+        # Not set in __init__, since ndb doesn't always call it:
+        return self.__dict__.setdefault('_loaded_issue_data', {})
+
+    @property
+    def _modified_data(self):
+        return self.__dict__.setdefault('_modified_issue_data', set())
+
+    def load_data(self, *names):
+        """
+        Loads the given IssueData children (by default, all of them) in one batch, skipping
+        those that have already been loaded or assigned.
+        """
+        names = [name for name in (names or Issue.DATA_NAMES) if name not in self._issue_data]
+        if not names:
+            return
+        children = [None] * len(names)
+        if self.key is not None:
+            children = ndb.get_multi([ndb.Key(IssueData, name, parent=self.key) for name in names])
+        for (name, child) in zip(names, children):
+            if child is not None:
+                self._issue_data[name] = child.json
+            else:
+                self._issue_data[name] = getattr(self, 'legacy_' + name)
+
+    def modified_data(self):
+        """
+        Returns the IssueData children that were assigned since they were loaded, which must be
+        written along with this issue, and then considers them unmodified.  Their legacy copies
+        are cleared so that the issue no longer stores them.
+        """
+        children = []
+        for name in sorted(self._modified_data):
+            children.append(IssueData(id=name, parent=self.key, json=self._issue_data[name]))
+            setattr(self, 'legacy_' + name, None)
+        self._modified_data.clear()
+        return children
 
     @property
     def components(self):
@@ -96,15 +181,18 @@ class Issue(ndb.Model):
 
         Components are identified automatically based on the files that the pull request
         modified and any tags added to the pull request's title (such as [GraphX]).
+        The result is cached on the issue and only recomputed when its title, its files or the
+        classification rules change.
         """
-        components = []
-        title = ((self.pr_json and self.pr_json["title"]) or self.title or "")
-        modified_files = [f["filename"] for f in (self.files_json or [])]
-        for (component_name, pr_title_regex, filename_regex) in Issue._components:
-            if re.search(pr_title_regex, title, re.IGNORECASE) or \
-                    any(re.search(filename_regex, f, re.I) for f in modified_files):
-                components.append(component_name)
-        return components or ["Core"]
+        title = self.raw_title
+        cache_key = hashlib.sha1((u"%s\n%s\n%s" % (Issue._components_digest, self.files_etag,
+                                                   title)).encode('utf-8')).hexdigest()
+        if self.components_cache_key != cache_key:
+            modified_files = [f["filename"] for f in (self.files_json or [])]
+            self.cached_components = \
+                Issue._component_classifier.classify(title, modified_files) or ["Core"]
+            self.components_cache_key = cache_key
+        return self.cached_components
 
     @property
     def raw_title(self):
@@ -137,38 +225,45 @@ class Issue(ndb.Model):
 
     @property
     def lines_changed(self):
-        if self.lines_added != "":
+        # PRs that were seeded from GitHub's list of pull requests don't have line counts until
+        # they are updated individually:
+        if self.lines_added not in ("", None):
             return self.lines_added + self.lines_deleted
         else:
             return 0
 
     @property
     def is_mergeable(self):
-        return self.pr_json and self.pr_json["mergeable"]
-
-    @property
-    def commenters(self):
-        if self.cached_commenters is None:
-            self.cached_commenters = self._compute_commenters()
-            self.put()
-        return self.cached_commenters
-
-    @property
-    def last_jenkins_outcome(self):
-        if self.cached_last_jenkins_outcome is None:
-            (outcome, comment) = compute_last_jenkins_outcome(self.comments_json)
-            self.cached_last_jenkins_outcome = outcome
-            self.last_jenkins_comment = comment
-            self.put()
-        return self.cached_last_jenkins_outcome
+        return self.pr_json and self.pr_json.get("mergeable")
 
     def _compute_commenters(self):
-        res = defaultdict(dict)  # Indexed by user, since we only display each user once.
-        excluded_users = set(("SparkQA", "AmplabJenkins"))
+        """
+        Returns (user, info) pairs for the users who commented on this pull request, most recent
+        first.
+
+        This is computed incrementally: if the comments created up to the high-water mark in
+        commenters_state haven't changed, then only the newer comments are folded into
+        cached_commenters.  If earlier comments were edited or deleted (or arrived late, since
+        review comments are synced separately), everything is recomputed.
+        """
         all_comments = sorted((self.comments_json or []) + (self.pr_comments_json or []),
                               key=lambda c: c['created_at'])
-        for comment in all_comments:
-            if is_jenkins_command(comment['body']):
+        state = self.commenters_state
+        res = defaultdict(dict)  # Indexed by user, since we only display each user once.
+        new_comments = all_comments
+        if state and self.cached_commenters is not None:
+            processed_comments = [c for c in all_comments if c['created_at'] <= state['watermark']]
+            if Issue._digest_comments(processed_comments) == state['digest']:
+                res.update((user, dict(d)) for (user, d) in self.cached_commenters)
+                new_comments = all_comments[len(processed_comments):]
+        self.commenters_state = {
+            'watermark': all_comments[-1]['created_at'] if all_comments else '',
+            'digest': Issue._digest_comments(all_comments),
+        }
+        excluded_users = set(("SparkQA", "AmplabJenkins"))
+        for comment in new_comments:
+            analysis = analyze_github_comment(comment)
+            if analysis['only_jenkins_commands']:
                 continue  # Skip comments that solely consist of Jenkins commands
             # If a user deletes their GitHub account, the 'user' field of their comments seems to
             # become 'null' in the JSON (although it points to the user info for the 'ghost' user
@@ -183,13 +278,72 @@ class Issue(ndb.Model):
                 # Display at most 10 lines of context for comments left on diffs:
                 user_dict['diff_hunk'] = '\n'.join(
                     comment.get('diff_hunk', '').split('\n')[-10:])
-                user_dict['said_lgtm'] = (user_dict.get('said_lgtm') or
-                                          re.search("lgtm", comment['body'], re.I) is not None)
+                user_dict['said_lgtm'] = user_dict.get('said_lgtm') or analysis['lgtm']
                 user_dict['asked_to_close'] = \
-                    (user_dict.get('asked_to_close') or
-                        Issue.ASKED_TO_CLOSE_REGEX.search(comment['body']) is not None)
+                    user_dict.get('asked_to_close') or analysis['asked_to_close']
         return sorted(res.items(), key=lambda x: x[1]['date'], reverse=True)
 
+    @staticmethod
+    def _digest_comments(comments):
+        """
+        Returns a digest that changes whenever one of the given comments is edited, or when a
+        comment is added to or removed from the list.
+        """
+        return hashlib.sha1('\n'.join(
+            "%s %s" % (c['html_url'], c.get('updated_at')) for c in comments)).hexdigest()
+
+    def to_summary_dict(self):
+        """
+        Returns the JSON-serializable dict that the PR list endpoints serve for this issue.
+
+        JIRA fields are not included here; they're joined in at request time because JIRA issues
+        are synchronized independently of pull requests.
+        """
+        # Fill the caches without calling put(), since our caller is about to write this issue:
+        if self.cached_commenters is None:
+            self.cached_commenters = self._compute_commenters()
+        if self.cached_last_jenkins_outcome is None:
+            (self.cached_last_jenkins_outcome, self.last_jenkins_comment) = \
+                compute_last_jenkins_outcome(self.comments_json)
+        last_jenkins_comment_dict = None
+        if self.last_jenkins_comment:
+            last_jenkins_comment_dict = {
+                'body': self.last_jenkins_comment['body'],
+                'user': {'login': self.last_jenkins_comment['user']['login']},
+                'html_url': self.last_jenkins_comment['html_url'],
+                'date': [self.last_jenkins_comment['created_at']],
+            }
+        committers = app.config.get('COMMITTER_GITHUB_USERNAMES', [])
+        return {
+            'parsed_title': self.parsed_title,
+            'number': self.number,
+            'updated_at': str(self.updated_at),
+            'user': self.user,
+            'state': self.state,
+            'components': self.components,
+            'lines_added': self.lines_added,
+            'lines_deleted': self.lines_deleted,
+            'lines_changed': self.lines_changed,
+            'is_mergeable': self.is_mergeable,
+            'commenters': [
+                {
+                    'username': u,
+                    'data': d,
+                    'is_committer': u in committers,
+                } for (u, d) in self.cached_commenters],
+            'last_jenkins_outcome': self.cached_last_jenkins_outcome,
+            'last_jenkins_comment': last_jenkins_comment_dict,
+        }
+
+    def put_with_summary(self):
+        """
+        Writes this issue, its modified IssueData children and its refreshed `IssueSummary` in a
+        single batch.  Call this from a cross-group transaction (see `tasks.update_issue`) to
+        merge the changes with those of concurrent tasks.
+        """
+        summary = IssueSummary.from_issue(self)
+        ndb.put_multi([self, summary] + self.modified_data())
+
     @classmethod
     def get_or_create(cls, number):
         key = str(ndb.Key("Issue", number).id())
@@ -201,6 +355,123 @@ class Issue(ndb.Model):
         return Issue.get_by_id(key)
 
 
+class IssueData(ndb.Model):
+    """
+    One part of an `Issue`'s raw GitHub JSON (its comments, review comments or files), which is
+    stored as a child entity of the issue so that the task that syncs it doesn't have to rewrite
+    the others.  Keyed by the name of the `Issue` property that exposes it.
+    """
+    json = ndb.JsonProperty(compressed=True)
+
+
+class IssueSummary(ndb.Model):
+    """
+    A denormalized, ready-to-serve copy of an `Issue`'s row in the PR list endpoints.
+
+    The sync tasks rewrite an issue's summary whenever they update the issue, so serving the
+    list of open PRs only requires one indexed query over these small entities rather than
+    loading every issue's raw GitHub JSON and re-deriving its title, components and commenters.
+    Summaries share their key id with the corresponding `Issue`.
+    """
+
+    number = ndb.IntegerProperty(required=True)
+    state = ndb.StringProperty()
+    updated_at = ndb.DateTimeProperty()
+    jiras = ndb.IntegerProperty(repeated=True)
+    summary_json = ndb.JsonProperty(compressed=True)
+    # When this summary was last written; used as the watermark for incremental list updates:
+    modified_at = ndb.DateTimeProperty(auto_now=True)
+    # Indexed copies of fields from `summary_json`, used to filter the PR list on the server:
+    user = ndb.StringProperty()
+    components = ndb.StringProperty(repeated=True)
+    commenters = ndb.StringProperty(repeated=True)
+    last_jenkins_outcome = ndb.StringProperty()
+    # Indexed copies of fields from the PR's JIRAs, refreshed whenever one of those JIRAs changes:
+    jira_priority = ndb.StringProperty()
+    jira_target_versions = ndb.StringProperty(repeated=True)
+
+    @classmethod
+    def from_issue(cls, issue):
+        key = str(ndb.Key("IssueSummary", issue.number).id())
+        summary_json = issue.to_summary_dict()
+        summary = IssueSummary(id=key, number=issue.number, state=issue.state,
+                               updated_at=issue.updated_at,
+                               jiras=summary_json['parsed_title']['jiras'],
+                               summary_json=summary_json,
+                               user=summary_json['user'],
+                               components=summary_json['components'],
+                               commenters=[c['username'] for c in summary_json['commenters']],
+                               last_jenkins_outcome=summary_json['last_jenkins_outcome'])
+        summary.update_jira_fields()
+        return summary
+
+    @classmethod
+    def refresh_jira_fields(cls, jira_numbers):
+        """
+        Updates the JIRA fields of every open PR's summary that references one of the given JIRAs.
+        Closed PRs aren't listed with their JIRA fields, so they're left as they are.
+        """
+        # Queries can only have up to 30 IN values:
+        futures = [IssueSummary.query(IssueSummary.state == "open",
+                                      IssueSummary.jiras.IN(numbers)).fetch_async(keys_only=True)
+                   for numbers in chunked(jira_numbers, 30)]
+        for key in set(key for future in futures for key in future.get_result()):
+            IssueSummary._refresh_summary_jira_fields(key)
+
+    @staticmethod
+    @ndb.transactional
+    def _refresh_summary_jira_fields(key):
+        # Transactional, so that we don't overwrite a summary that a sync task rewrote meanwhile:
+        summary = key.get()
+        if summary is not None:
+            old_fields = (summary.jira_priority, summary.jira_target_versions)
+            summary.update_jira_fields()
+            # Most JIRA updates don't change these fields, so skip the write when they don't:
+            if (summary.jira_priority, summary.jira_target_versions) != old_fields:
+                summary.put()
+
+    @ndb.non_transactional
+    def update_jira_fields(self):
+        # Mirror the list's "Priority" and "Target Versions" columns: the priority comes from the
+        # first JIRA, while the target versions are the union of all of the JIRAs' versions.
+        keys = [ndb.Key("JIRAIssue", "%s-%i" % (app.config['JIRA_PROJECT'], n))
+                for n in self.jiras]
+        jiras = ndb.get_multi(keys)
+        self.jira_priority = jiras[0].priority_name if jiras and jiras[0] else None
+        self.jira_target_versions = sorted(set(v for jira in jiras if jira
+                                               for v in jira.target_versions))
+
+
+class RenderedPRList(ndb.Model):
+    """
+    A pre-rendered, gzipped JSON PR list, keyed by the list's name.  Rendered lists are cached in
+    memcache; these entities are the fallback for when memcache has evicted them.
+    """
+    gzip_body = ndb.BlobProperty()
+    etag = ndb.StringProperty(indexed=False)
+    version = ndb.StringProperty(indexed=False)
+    rendered_at = ndb.DateTimeProperty(indexed=False)
+
+
+class BotCommentCleanup(ndb.Model):
+    """
+    Records which of a pull request's obsolete AmplabJenkins and SparkQA comments have already
+    been deleted, so that cleanup tasks don't try to delete them again.  Keyed by the pull
+    request's number.
+    """
+    deleted_comment_ids = ndb.IntegerProperty(repeated=True, indexed=False)
+
+
+class JIRALinkRecord(ndb.Model):
+    """
+    Records the pull requests that have already been linked from a JIRA issue, and those for
+    which the issue's progress has already been started, so that updating those pull requests
+    again doesn't have to ask JIRA.  Keyed by the JIRA issue's key, e.g. SPARK-6481.
+    """
+    linked_pr_urls = ndb.StringProperty(repeated=True, indexed=False)
+    progress_pr_urls = ndb.StringProperty(repeated=True, indexed=False)
+
+
 class JIRAIssue(ndb.Model):
     """
     Models an issue from JIRA.
@@ -214,6 +485,10 @@ class JIRAIssue(ndb.Model):
 
     issue_id = ndb.StringProperty(required=True)
     issue_json = ndb.JsonProperty(compressed=True)
+    modified_at = ndb.DateTimeProperty(auto_now=True)
+
+    # The fields of `issue_json` that the properties below read; only these are fetched:
+    FIELDS = ['status', 'priority', 'issuetype', 'customfield_12311620', 'customfield_12310320']
 
     @property
     def is_closed(self):
@@ -262,8 +537,21 @@ class JIRAIssue(ndb.Model):
         key = str(ndb.Key("JIRAIssue", issue_id).id())
         return JIRAIssue.get_or_insert(key, issue_id=issue_id)
 
+    @classmethod
+    def put_from_search(cls, issue_jsons):
+        """
+        Stores the issues from a page of JIRA search results in one batch, and then refreshes the
+        summaries of the PRs that reference them.
+        """
+        ndb.put_multi([JIRAIssue(id=j['key'], issue_id=j['key'],
+                                 issue_json={'key': j['key'], 'fields': j['fields']})
+                       for j in issue_jsons])
+        IssueSummary.refresh_jira_fields([int(j['key'].split('-')[-1]) for j in issue_jsons])
+
     def update(self):
         logging.debug("Updating JIRA issue %s" % self.issue_id)
-        url = "%s/rest/api/latest/issue/%s" % (app.config['JIRA_API_BASE'], self.issue_id)
+        url = "%s/rest/api/latest/issue/%s?fields=%s" % \
+            (app.config['JIRA_API_BASE'], self.issue_id, ','.join(JIRAIssue.FIELDS))
         self.issue_json = json.loads(urlfetch.fetch(url).content)
         self.put()  # Write our modifications back to the database
+        IssueSummary.refresh_jira_fields([int(self.issue_id.split('-')[-1])])
@@ -0,0 +1,48 @@
+"""
+Helpers for enqueueing tasks in bulk, and for dropping duplicate tasks using deterministic names.
+"""
+import logging
+import re
+
+from google.appengine.api import taskqueue
+from more_itertools import chunked
+
+
+# The task queue API accepts at most this many tasks per call:
+MAX_TASKS_PER_CALL = 100
+
+
+def task_name(*parts):
+    """
+    Returns a deterministic task name made from `parts`.  Only one task with a given name can
+    be added to a queue (even after it has run, until its name's tombstone expires after about
+    a week), so tasks that are named after the work that they do are never duplicated.
+    """
+    return re.sub(r'[^a-zA-Z0-9_-]', '-', '-'.join(str(part) for part in parts))
+
+
+def enqueue_tasks(tasks, queue_name='default'):
+    """
+    Enqueues `taskqueue.Task`s in batches of up to MAX_TASKS_PER_CALL, issuing all of the batches'
+    adds concurrently.  Named tasks that duplicate another task in `tasks` or a task that was
+    already added to the queue are dropped.
+
+    :return: the number of tasks that were added, not counting dropped duplicates.
+    """
+    (unique_tasks, names) = ([], set())
+    for task in tasks:
+        if task.name is None or task.name not in names:
+            unique_tasks.append(task)
+            names.add(task.name)
+    queue = taskqueue.Queue(queue_name)
+    rpcs = [queue.add_async(batch) for batch in chunked(unique_tasks, MAX_TASKS_PER_CALL)]
+    for rpc in rpcs:
+        try:
+            rpc.get_result()
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            # The batch's other tasks are still added:
+            pass
+    added = sum(1 for task in unique_tasks if task.was_enqueued)
+    if added < len(unique_tasks):
+        logging.debug("Dropped %i duplicate tasks" % (len(unique_tasks) - added))
+    return added
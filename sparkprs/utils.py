@@ -13,6 +13,38 @@ JENKINS_COMMAND_REGEX = r"""
        |(skip\s+ci))
        \.?
 """
+JENKINS_COMMAND_PATTERN = re.compile(JENKINS_COMMAND_REGEX, re.I | re.X)
+ONLY_JENKINS_COMMANDS_PATTERN = re.compile("^(%s\s*)+$" % JENKINS_COMMAND_REGEX, re.I | re.X)
+
+ASKED_TO_CLOSE_REGEX = r"""
+        (mind\s+closing\s+(this|it))|
+        (close\s+this\s+(issue|pr))
+"""
+
+# Finds everything that the dashboard looks for in a comment in a single scan of its body.  Each
+# alternative is a named group, and `analyze_comment` records which of them matched.  The
+# alternatives don't contain each other's text, except that the build status messages include
+# the "started" and "timed out" keywords, so those are handled by `analyze_comment`.
+COMMENT_ANALYSIS_PATTERN = re.compile(r"""
+        (?P<build_started>test\ build\ \#(?P<started_build_id>\d+)\ has\ started)
+       |(?P<build_ended>test\ build\ \#(?P<ended_build_id>\d+)
+            \ (has\ finished|(?P<build_timed_out>timed\ out)))
+       |(?P<jenkins_command>%s)
+       |(?P<lgtm>lgtm)
+       |(?P<asked_to_close>%s)
+       |(?P<verify>can\ one\ of\ the\ admins\ verify\ this\ patch\?)
+       |(?P<passed>pass)
+       |(?P<failed>fail)
+       |(?P<started>started)
+       |(?P<timed_out>timed\ out)
+""" % (JENKINS_COMMAND_REGEX, ASKED_TO_CLOSE_REGEX), re.I | re.X)
+
+COMMENT_FLAGS = ['jenkins_command', 'lgtm', 'asked_to_close', 'verify', 'passed', 'failed',
+                 'started', 'timed_out']
+
+# Maximum number of comment analyses cached by `analyze_github_comment` (each is about 1 KB):
+MAX_CACHED_ANALYSES = 5000
+_comment_analysis_cache = {}
 
 
 def contains_jenkins_command(comment):
@@ -22,7 +54,7 @@ def contains_jenkins_command(comment):
     >>> contains_jenkins_command("LGTM, pending Jenkins.  Jenkins, retest this please.")
     True
     """
-    return re.search(JENKINS_COMMAND_REGEX, comment, re.I | re.X) is not None
+    return JENKINS_COMMAND_PATTERN.search(comment) is not None
 
 
 def is_jenkins_command(comment):
@@ -49,8 +81,102 @@ def is_jenkins_command(comment):
     False
     """
     # Check that the comment string is one or more Jenkins commands:
-    regex = "^(%s\s*)+$" % JENKINS_COMMAND_REGEX
-    return re.match(regex, comment.strip().replace(r"\n", ' '), re.I | re.X) is not None
+    return ONLY_JENKINS_COMMANDS_PATTERN.match(comment.strip().replace(r"\n", ' ')) is not None
+
+
+def analyze_comment(body):
+    """
+    Classifies a comment's body in a single scan, returning a dict with boolean `jenkins_command`,
+    `only_jenkins_commands`, `lgtm`, `asked_to_close` and `verify` flags; `passed`, `failed`,
+    `started` and `timed_out` flags for the build status keywords; and the ids of the builds
+    that the comment says have `started_build` or `ended_build` (or None).
+
+    >>> analysis = analyze_comment("LGTM.  Jenkins, retest this please.")
+    >>> [analysis[flag] for flag in ['lgtm', 'jenkins_command', 'only_jenkins_commands']]
+    [True, True, False]
+    >>> analyze_comment("Jenkins, this is ok to test.")['only_jenkins_commands']
+    True
+    >>> analysis = analyze_comment("Test build #123 has started for PR 45 at commit abc.")
+    >>> (analysis['started_build'], analysis['ended_build'], analysis['started'])
+    ('123', None, True)
+    >>> analysis = analyze_comment("Test build #123 timed out for PR 45 at commit abc.")
+    >>> (analysis['ended_build'], analysis['timed_out'], analysis['failed'])
+    ('123', True, False)
+    >>> analyze_comment("Would you mind closing this PR?")['asked_to_close']
+    True
+    """
+    analysis = dict.fromkeys(COMMENT_FLAGS, False)
+    analysis['started_build'] = None
+    analysis['ended_build'] = None
+    for match in COMMENT_ANALYSIS_PATTERN.finditer(body):
+        if match.group('build_started'):
+            analysis['started_build'] = analysis['started_build'] or match.group('started_build_id')
+            analysis['started'] = True
+        elif match.group('build_ended'):
+            analysis['ended_build'] = analysis['ended_build'] or match.group('ended_build_id')
+            analysis['timed_out'] = analysis['timed_out'] or bool(match.group('build_timed_out'))
+        else:
+            for flag in COMMENT_FLAGS:
+                if match.group(flag):
+                    analysis[flag] = True
+                    break
+    # Only comments that contain a command (perhaps split by an escaped newline, which
+    # is_jenkins_command treats as a space) can consist solely of commands:
+    analysis['only_jenkins_commands'] = \
+        (analysis['jenkins_command'] or r"\n" in body) and is_jenkins_command(body)
+    return analysis
+
+
+def analyze_github_comment(comment):
+    """
+    Returns `analyze_comment`'s analysis of a comment from GitHub's JSON.  Analyses are cached
+    by the comment's id and last update time, so the different consumers of a comment's analysis
+    and later syncs of the same pull request only analyze it once.
+    """
+    key = (comment.get('id') or comment['html_url'], comment.get('updated_at'))
+    analysis = _comment_analysis_cache.get(key)
+    if analysis is None:
+        if len(_comment_analysis_cache) >= MAX_CACHED_ANALYSES:
+            _comment_analysis_cache.clear()
+        analysis = _comment_analysis_cache[key] = analyze_comment(comment['body'])
+    return analysis
+
+
+class ComponentClassifier(object):
+    """
+    Classifies pull requests into components based on their titles and modified files, given a
+    list of (name, pr_title_regex, filename_regex) rules.
+
+    The rules' regexes are compiled once.  Rather than searching every file name separately,
+    each filename regex scans all of the file names in a single pass over a newline-joined
+    string (in multiline mode, so that '^' still anchors to the start of each path).  Filename
+    regexes are lowercased and matched against lowercased file names instead of using re.I,
+    which lets the regex engine use its fast literal search; as a result, they shouldn't use
+    uppercase escapes such as \\S or \\W.
+
+    >>> classifier = ComponentClassifier([
+    ...     ("Core", "core", "^core/"),
+    ...     ("SQL", "sql", "sql"),
+    ...     ("R", "SparkR", "(^r/)|src/main/r/")])
+    >>> classifier.classify("[SQL] Fix a bug", [])
+    ['SQL']
+    >>> classifier.classify("Fix a bug", ["core/src/main/Foo.scala", "R/pkg/R/DataFrame.R"])
+    ['Core', 'R']
+    >>> classifier.classify("Fix a bug", ["sql/core/src/main/Foo.scala"])
+    ['SQL']
+    >>> classifier.classify("Fix a bug", ["README.md"])
+    []
+    """
+
+    def __init__(self, components):
+        self._rules = [
+            (name, re.compile(title_regex, re.I), re.compile(filename_regex.lower(), re.M))
+            for (name, title_regex, filename_regex) in components]
+
+    def classify(self, title, filenames):
+        all_filenames = "\n".join(filenames).lower()
+        return [name for (name, title_regex, filename_regex) in self._rules
+                if title_regex.search(title) or filename_regex.search(all_filenames)]
 
 
 def parse_pr_title(pr_title):
@@ -115,29 +241,240 @@ def compute_last_jenkins_outcome(comments_json):
     prev_author = None
     for comment in (comments_json or []):
         author = comment['user']['login']
-        body = comment['body'].lower()
-        if contains_jenkins_command(body):
+        analysis = analyze_github_comment(comment)
+        if analysis['jenkins_command']:
             status = "Asked"
             jenkins_comment = comment
         elif author == "AmplabJenkins":
-            if "can one of the admins verify this patch?" in body:
+            if analysis['verify']:
                 jenkins_comment = comment
                 status = "Verify"
-            elif "fail" in body and \
+            elif analysis['failed'] and \
                     (prev_author != "SparkQA" or status not in ("Fail", "Timeout")):
                 jenkins_comment = comment
                 status = "Fail"
         elif author == "SparkQA":
-            if "pass" in body:
+            if analysis['passed']:
                 status = "Pass"
-            elif "fail" in body:
+            elif analysis['failed']:
                 status = "Fail"
-            elif "started" in body:
+            elif analysis['started']:
                 status = "Running"
-            elif "timed out" in body:
+            elif analysis['timed_out']:
                 status = "Timeout"
             else:
                 status = "Unknown"  # So we display "Unknown" instead of out-of-date status
             jenkins_comment = comment
         prev_author = author
     return (status, jenkins_comment)
+
+
+def prune_json(value, schema):
+    """
+    Returns a copy of a JSON value that only contains the fields listed in `schema`.  A schema is
+    a dict that maps the names of the fields to keep either to None, to keep the field's value
+    as-is, or to the schema for pruning that value.  Lists are pruned element-wise, and missing
+    fields and null values are left alone.
+
+    >>> prune_json({'a': 1, 'b': 2}, {'a': None})
+    {'a': 1}
+    >>> prune_json({'a': {'b': 1, 'c': 2}}, {'a': {'b': None}, 'd': None})
+    {'a': {'b': 1}}
+    >>> prune_json([{'a': 1, 'b': 2}, {'a': None, 'b': 4}], {'a': {'c': None}})
+    [{'a': 1}, {'a': None}]
+    >>> prune_json(None, {'a': None})
+    """
+    if schema is None or value is None:
+        return value
+    elif isinstance(value, list):
+        return [prune_json(v, schema) for v in value]
+    elif isinstance(value, dict):
+        return dict((k, prune_json(value[k], schema[k])) for k in schema if k in value)
+    else:
+        return value
+
+
+def fetch_graphql_connections(query_object, variables, connections):
+    """
+    Fetches an object from a GraphQL API along with every node of its paginated connections,
+    issuing continuation queries for the connections that have more pages.  Each continuation
+    query only includes the connections that still have pages left.
+
+    `connections` lists (name, include variable, cursor variable) triples, which this sets in
+    `variables`, and `query_object(variables)` runs the query and returns the object, or None if
+    it doesn't exist.
+
+    :return: the object from the first query and a dict of each connection's nodes, or None.
+
+    For example, with these recorded responses for a pull request:
+
+    >>> responses = {
+    ...     (None, None): {
+    ...         'number': 1,
+    ...         'comments': {'nodes': ['c1', 'c2'],
+    ...                      'pageInfo': {'hasNextPage': True, 'endCursor': 'C2'}},
+    ...         'files': {'nodes': ['f1'], 'pageInfo': {'hasNextPage': False, 'endCursor': 'F1'}},
+    ...     },
+    ...     ('C2', 'F1'): {
+    ...         'number': 1,
+    ...         'comments': {'nodes': ['c3'],
+    ...                      'pageInfo': {'hasNextPage': False, 'endCursor': 'C3'}},
+    ...     },
+    ... }
+    >>> def query_object(variables):
+    ...     # The files are complete after the first page, so they aren't queried again:
+    ...     assert variables['withFiles'] == (variables['filesCursor'] is None)
+    ...     return responses[(variables['commentsCursor'], variables['filesCursor'])]
+    >>> connections = [('comments', 'withComments', 'commentsCursor'),
+    ...                ('files', 'withFiles', 'filesCursor')]
+    >>> (pr, nodes) = fetch_graphql_connections(query_object, {}, connections)
+    >>> pr['number'], sorted(nodes.items())
+    (1, [('comments', ['c1', 'c2', 'c3']), ('files', ['f1'])])
+    >>> fetch_graphql_connections(lambda variables: None, {}, connections)
+    """
+    for (name, include_var, cursor_var) in connections:
+        variables[include_var] = True
+        variables[cursor_var] = None
+    nodes = dict((name, []) for (name, _, _) in connections)
+    first_page = None
+    while any(variables[include_var] for (_, include_var, _) in connections):
+        page = query_object(variables)
+        if page is None:
+            return None
+        first_page = first_page or page
+        for (name, include_var, cursor_var) in connections:
+            if variables[include_var]:
+                nodes[name].extend(page[name]['nodes'])
+                page_info = page[name]['pageInfo']
+                variables[include_var] = page_info['hasNextPage']
+                variables[cursor_var] = page_info['endCursor']
+    return (first_page, nodes)
+
+
+def graphql_user_json(author):
+    """
+    Converts a GraphQL author into the REST API's user JSON.  Authors of deleted accounts are
+    null, as with the REST API's 'user' field.
+
+    >>> graphql_user_json({'login': 'octocat', 'avatarUrl': 'https://example.com/octocat.png'})
+    {'login': 'octocat', 'avatar_url': 'https://example.com/octocat.png'}
+    >>> graphql_user_json(None)
+    """
+    if author is None:
+        return None
+    return {'login': author['login'], 'avatar_url': author['avatarUrl']}
+
+
+def graphql_pr_json(pull_request):
+    """
+    Converts a GraphQL pull request into the fields of the REST API's pull request JSON that we
+    store.
+
+    >>> pr_json = graphql_pr_json({
+    ...     'number': 42, 'title': '[SPARK-1] Fix', 'state': 'MERGED', 'mergeable': 'UNKNOWN',
+    ...     'additions': 3, 'deletions': 1, 'createdAt': '2015-01-01T00:00:00Z',
+    ...     'updatedAt': '2015-01-02T00:00:00Z', 'url': 'https://github.com/apache/spark/pull/42',
+    ...     'headRefOid': 'abc123', 'baseRefName': 'master', 'author': None})
+    >>> [(k, pr_json[k]) for k in ('state', 'merged', 'mergeable', 'user', 'head', 'base')]
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('state', 'closed'), ('merged', True), ('mergeable', None),
+     ('user', {'login': 'ghost', 'avatar_url': None}), ('head', {'sha': 'abc123'}),
+     ('base', {'ref': 'master'})]
+    """
+    return {
+        'number': pull_request['number'],
+        'title': pull_request['title'],
+        'state': 'open' if pull_request['state'] == 'OPEN' else 'closed',
+        'merged': pull_request['state'] == 'MERGED',
+        'mergeable': {'MERGEABLE': True, 'CONFLICTING': False}.get(pull_request['mergeable']),
+        'additions': pull_request['additions'],
+        'deletions': pull_request['deletions'],
+        'created_at': pull_request['createdAt'],
+        'updated_at': pull_request['updatedAt'],
+        'html_url': pull_request['url'],
+        # GitHub attributes pull requests from deleted accounts to its 'ghost' user:
+        'user': graphql_user_json(pull_request['author']) or {'login': 'ghost', 'avatar_url': None},
+        'head': {'sha': pull_request['headRefOid']},
+        'base': {'ref': pull_request['baseRefName']},
+    }
+
+
+def graphql_comment_json(comment, url):
+    """
+    Converts a GraphQL issue comment or review comment into the REST API's comment JSON, given
+    the comment's REST API `url`.  Review comments' diff hunks are kept.
+
+    >>> comment = {'databaseId': 7, 'url': 'https://github.com/apache/spark/pull/42#r7',
+    ...            'body': 'LGTM', 'createdAt': '2015-01-01T00:00:00Z',
+    ...            'updatedAt': '2015-01-01T00:00:00Z', 'author': None, 'diffHunk': '@@ -1 +1 @@'}
+    >>> sorted(graphql_comment_json(comment, 'https://api.github.com/comments/7').items())
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('body', 'LGTM'), ('created_at', '2015-01-01T00:00:00Z'), ('diff_hunk', '@@ -1 +1 @@'),
+     ('html_url', 'https://github.com/apache/spark/pull/42#r7'), ('id', 7),
+     ('updated_at', '2015-01-01T00:00:00Z'), ('url', 'https://api.github.com/comments/7'),
+     ('user', None)]
+    """
+    comment_json = {
+        'id': comment['databaseId'],
+        'url': url,
+        'html_url': comment['url'],
+        'body': comment['body'],
+        'created_at': comment['createdAt'],
+        'updated_at': comment['updatedAt'],
+        'user': graphql_user_json(comment['author']),
+    }
+    if 'diffHunk' in comment:
+        comment_json['diff_hunk'] = comment['diffHunk']
+    return comment_json
+
+
+def graphql_file_json(pr_file):
+    """
+    >>> sorted(graphql_file_json({'path': 'docs/index.md', 'additions': 2, 'deletions': 0}).items())
+    [('additions', 2), ('deletions', 0), ('filename', 'docs/index.md')]
+    """
+    return {'filename': pr_file['path'], 'additions': pr_file['additions'],
+            'deletions': pr_file['deletions']}
+
+
+def advance_jira_watermark(watermark, issues):
+    """
+    Returns the JIRA sync's watermark after storing a page of search results, which must be
+    ordered by their update time.  The watermark is the minute in which the last stored issue was
+    updated, plus the number of issues from that minute to skip when searching from that minute
+    again; see update_jira_issues.
+
+    >>> def issue(updated):
+    ...     return {'fields': {'updated': updated}}
+    >>> def advance(watermark, *updated):
+    ...     watermark = advance_jira_watermark(watermark, [issue(u) for u in updated])
+    ...     return (watermark['minute'], watermark['skip'])
+
+    When a whole page is from the same minute, its issues are skipped when searching again:
+
+    >>> advance(None, "2015-03-24T05:34:12.000-0700", "2015-03-24T05:34:56.000-0700")
+    ('2015/03/24 05:34', 2)
+
+    Resuming from that watermark skips those issues, so the next page adds to the skip count:
+
+    >>> watermark = {'minute': '2015/03/24 05:34', 'skip': 2}
+    >>> advance(watermark, "2015-03-24T05:34:57.000-0700", "2015-03-24T05:34:58.000-0700")
+    ('2015/03/24 05:34', 4)
+
+    A page that spans minutes moves the watermark to its last minute.  The search from that
+    minute re-fetches its last issues, so nothing can be missed:
+
+    >>> advance(watermark, "2015-03-24T05:34:59.000-0700", "2015-03-24T05:35:01.000-0700")
+    ('2015/03/24 05:35', 0)
+    """
+    def minute(issue):
+        # JIRA returns dates like "2015-03-24T05:34:56.000-0700"; JQL expects "2015/03/24 05:34".
+        return issue['fields']['updated'][:16].replace('-', '/').replace('T', ' ')
+    last_minute = minute(issues[-1])
+    skip = 0
+    if minute(issues[0]) == last_minute:
+        # The whole page is from the same minute, so skip it when fetching that minute again:
+        if watermark is not None and watermark['minute'] == last_minute:
+            skip = watermark['skip']
+        skip += len(issues)
+    return {'minute': last_minute, 'skip': skip}
@@ -112,13 +112,13 @@ define([
       userDashboard: function(username) {
         return (
           React.createElement(UserDashboard, {
-            prs: this.state.prs, 
+            processPrs: this.processFetchedPrs, 
             username: username, 
             showJenkinsButtons: this.userCanUseJenkins()}));
       },
 
       getInitialState: function() {
-        return {prs: [], stalePrs: [], user: null, refreshInProgress: false};
+        return {prs: [], prsVersion: null, stalePrs: [], user: null, refreshInProgress: false};
       },
 
       processFetchedPrs: function(prs) {
@@ -132,16 +132,40 @@ define([
         });
       },
 
+      mergePrsDelta: function(delta) {
+        // Replace updated PRs, drop PRs that are no longer open, and keep the list sorted by
+        // descending update time (the order that the server uses):
+        this.processFetchedPrs(delta.prs);
+        var updatedPrs = _.indexBy(delta.prs, 'number');
+        var removedPrs = _.indexBy(delta.removed);
+        var unchangedPrs = _.reject(this.state.prs, function(pr) {
+          return _.has(updatedPrs, pr.number) || _.has(removedPrs, pr.number);
+        });
+        return _.sortBy(delta.prs.concat(unchangedPrs), 'updated_at').reverse();
+      },
+
       refreshPrs: function() {
         var _this = this;
+        var version = this.state.prsVersion;
         this.setState({refreshInProgress: true});
         console.log("Refreshing pull requests");
+        // After the initial load, only fetch the PRs that have changed since the last refresh:
         $.ajax({
           url: '/search-open-prs',
+          data: version ? {since: version} : {},
           dataType: 'json',
-          success: function(prs) {
-            _this.processFetchedPrs(prs);
-            _this.setState({prs: prs, refreshInProgress: false});
+          success: function(data, textStatus, jqXHR) {
+            var prs;
+            var newVersion;
+            if (version) {
+              prs = _this.mergePrsDelta(data);
+              newVersion = data.version;
+            } else {
+              prs = data;
+              _this.processFetchedPrs(prs);
+              newVersion = jqXHR.getResponseHeader('X-PR-Version');
+            }
+            _this.setState({prs: prs, prsVersion: newVersion, refreshInProgress: false});
             console.log("Done refreshing pull requests; prs.length=" + prs.length);
           },
           error: function() {
@@ -13,34 +13,34 @@ define([
       },
 
       componentWillMount: function() {
-        if (this.props.username !== '') {
-          this._prepareData(this.props.prs, this.props.username);
-        }
+        this._loadData(this.props.username);
       },
 
       componentWillReceiveProps: function(nextProps) {
-        if (nextProps.username !== '') {
-          this._prepareData(nextProps.prs, nextProps.username);
+        if (nextProps.username !== this.props.username) {
+          this.setState(this.getInitialState());
+          this._loadData(nextProps.username);
         }
       },
 
-      _prepareData: function(prs, username) {
-        var prsAuthored = [], prsCommentedOn = [];
-        for (var i = 0; i < prs.length; i++) {
-          if (prs[i].user === username) {
-            prsAuthored.push(prs[i]);
-          } else {
-            var commenters = prs[i].commenters;
-            for (var j = 0; j < commenters.length; j++) {
-              if (commenters[j].username === username) {
-                prsCommentedOn.push(prs[i]);
-                break;
-              }
+      _loadData: function(username) {
+        if (username === '') {
+          return;
+        }
+        var _this = this;
+        // Fetch just this user's PRs rather than searching the full list of open PRs:
+        $.ajax({
+          url: '/search-user-prs/' + encodeURIComponent(username),
+          dataType: 'json',
+          success: function(data) {
+            // Ignore responses for users that are no longer being displayed:
+            if (username === _this.props.username) {
+              _this.props.processPrs(data.authored);
+              _this.props.processPrs(data.commented_on);
+              _this.setState({prsAuthored: data.authored, prsCommentedOn: data.commented_on});
             }
           }
-        }
-
-        this.setState({prsAuthored: prsAuthored, prsCommentedOn: prsCommentedOn});
+        });
       },
 
       render: function() {